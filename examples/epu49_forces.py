@@ -0,0 +1,21 @@
+# Force and torque on the four EPU49 girders over a gap and phase grid
+# Run: python epu49_forces.py [phase mode]
+
+import sys
+import numpy as np
+
+import radiamodels.epu as repu
+import radiamodels.forces as rfo
+
+MODE = sys.argv[1] if len(sys.argv) > 1 else 'tibo'
+
+gaps = np.linspace(12, 50, 20)
+phases = np.linspace(0, 49/2, 20)
+
+forces = rfo.get_force_map(repu.get_epu, gaps, phases, mode=MODE, debug=True, nhalfperiods=10, period=49)
+
+for i, gap in enumerate(forces['gap']):
+    for j, phase in enumerate(forces['phase']):
+        line = ' '.join(f"{name} {f[0]:8.1f} {f[1]:8.1f} {f[2]:8.1f}"
+                        for name, f in zip(forces['girder'], forces['force'][i, j]))
+        print(f'gap {gap:6.2f} phase {phase:6.2f} force (N) {line}')
@@ -0,0 +1,43 @@
+# Check that importing radiamodels stays fast, eg for every worker of a sweep or MPI rank
+# Run: python import_time.py [budget in seconds]
+# Exits with status 1 if any import takes longer than the budget
+
+import sys
+import subprocess
+
+# Budget in seconds for a fresh interpreter to import a module (best of NREPEAT)
+BUDGET = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+NREPEAT = 5
+
+MODULES = [
+    'radiamodels.util',
+    'radiamodels.ivu',
+    'radiamodels.ivu_center',
+    'radiamodels.epu',
+    'radiamodels.ppmu',
+]
+
+CODE = 'import time; t0 = time.perf_counter(); import {}; print(time.perf_counter() - t0)'
+
+def import_time (module):
+    times = []
+    for i in range(NREPEAT):
+        out = subprocess.run([sys.executable, '-c', CODE.format(module)], capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.split()[-1]))
+    return min(times)
+
+
+# radia itself is the floor, it has to be imported anyway
+t_radia = import_time('radia')
+print(f'{"radia":25s} {t_radia:.3f} s')
+
+failed = []
+for module in MODULES:
+    t = import_time(module)
+    print(f'{module:25s} {t:.3f} s')
+    if t > BUDGET:
+        failed.append(module)
+
+if failed:
+    print('Over the budget of', BUDGET, 's:', ', '.join(failed))
+    exit(1)
@@ -1,6 +1,9 @@
 import radia as rad
 import radiamodels.ivu as ri
 import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.integrals as rint
+import radiamodels.kickmap as rk
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -35,7 +38,7 @@ print('solve time', round(time.time() - tstart, 3), '(s)')
 
 # Full undulator
 Z = np.linspace(-1.7*PERIOD*NHALFPERIODS/4, 1.7*PERIOD*NHALFPERIODS/4, 1001)
-B = [rad.Fld(undulator, 'b', [0, 0, z]) for z in Z]
+B = rf.get_field_z(undulator, Z)
 
 # Just part to take effective field from
 zstart = -PERIOD + PERIOD * NHALFPERIODS%4/4
@@ -46,10 +49,10 @@ plt.figure()
 plt.title(f'Undulator Magnetic Field')
 plt.xlabel('Z (mm)')
 plt.ylabel('Magnetic Field (T)')
-plt.plot(Z, [b[0] for b in B], label='Bx')
-plt.plot(Z, [b[1] for b in B], label='By')
-plt.plot(Z, [b[2] for b in B], label='Bz')
-mymax=[max([np.abs(b[i]) for b in B]) for i in range(3)]
+plt.plot(Z, B[:, 0], label='Bx')
+plt.plot(Z, B[:, 1], label='By')
+plt.plot(Z, B[:, 2], label='Bz')
+mymax=np.max(np.abs(B), axis=0)
 plt.axhline(+mymax[1], linestyle='--', color='tab:cyan', label=f'$\\pm$ {round(mymax[1], 2)}')
 plt.axhline(-mymax[1], linestyle='--', color='tab:cyan')
 plt.axvline(zstart, color='tab:purple', linestyle='-.', linewidth=1, label='$B_{eff}$ Region')
@@ -60,16 +63,16 @@ plt.savefig('ivu18_bfield.png')
 if show: plt.show()
 
 Z2P = np.linspace(zstart, zstop, 5001)
-B2P = [rad.Fld(undulator, 'b', [0, 0, z]) for z in Z2P]
-ByEffMag = ru.get_beff(Z2P, [b[1] for b in B2P], 2)
+B2P = rf.get_field_z(undulator, Z2P)
+ByEffMag = ru.get_beff(Z2P, B2P[:, 1], 2)
 ByEff = [-ByEffMag*np.sin(2*np.pi/PERIOD * z + 2*np.pi*(NHALFPERIODS%4/4)) for z in Z2P]
 plt.figure()
 plt.title(f'Undulator Effective Field')
 plt.xlabel('Z (mm)')
 plt.ylabel('Magnetic Field (T)')
-plt.plot(Z2P, [b[0] for b in B2P], label='Bx')
-plt.plot(Z2P, [b[1] for b in B2P], label='By')
-plt.plot(Z2P, [b[2] for b in B2P], label='Bz')
+plt.plot(Z2P, B2P[:, 0], label='Bx')
+plt.plot(Z2P, B2P[:, 1], label='By')
+plt.plot(Z2P, B2P[:, 2], label='Bz')
 plt.plot(Z2P, ByEff, '--', label='$By_{eff}$ = ' + f'{round(ByEffMag, 2)}')
 plt.legend()
 plt.grid()
@@ -81,7 +84,8 @@ print('Keff', 0.09336*ByEffMag*PERIOD)
 
 # Look at first field integral
 X = np.linspace(-10, 10, 21)
-I1Y = [TMM2GCM*rad.FldInt(undulator, 'inf', 'iby', [x, 0, -10], [x, 0, 10]) for x in X]
+integrals = rint.get_field_integrals(undulator, X, 0)
+I1Y = TMM2GCM*integrals['i1y'][:, 0]
 
 plt.figure()
 plt.title('Undulator first field Integrals')
@@ -94,3 +98,8 @@ plt.axhline(-50, linestyle='--', color='tab:cyan')
 plt.legend()
 if show: plt.show()
 
+
+
+# Kick map for tracking codes
+kickmap = rk.get_kickmap(undulator, np.linspace(-10, 10, 41), np.linspace(-2, 2, 21), -1000, 1000)
+rk.write_kickmap(kickmap, 'ivu18_kickmap.txt', comment='IVU18 kick map')
@@ -0,0 +1,18 @@
+# Iterations and time of a coarse-to-fine solve of IVU18 against a solve from zero
+# Run: python ivu18_coarse_to_fine.py [nhalfperiods]
+
+import sys
+
+import radiamodels.ivu as ri
+import radiamodels.magnetization as rm
+from ivu18_defaults import ivu18args
+
+ivu18args.update({
+    'nhalfperiods': int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+})
+
+model, report = rm.solve_coarse_to_fine(ri.get_ivu, compare=True, debug=True, **ivu18args)
+
+total = report['coarse_time'] + report['transfer_time'] + report['fine_time']
+print(f"fine iterations {report['fine_niter']} (from zero {report['cold_niter']}), "
+      f"time {total:.1f} s (from zero {report['cold_time']:.1f} s)")
@@ -1,6 +1,3 @@
-import radia as rad
-import radiamodels.util as ru
-
 ivu18args = dict({
     'gap': 4.63,
     'taper': 0,
@@ -9,7 +6,7 @@ ivu18args = dict({
     'nhalfperiods': 8,
 
     'half_pole_size': [38/2, 21.5, 2.8],
-    'pole_material': ru.get_magnetic_material_permendur(),
+    'pole_material': None, # permendur, created by get_ivu
     'pole_body_divisions': [6, [5, 5], 4],
     'pole_tip_divisions': [5, [5, 6], 5],
     'pole_chamfer_shortedge': 3,
@@ -18,7 +15,7 @@ ivu18args = dict({
     'pole_offset_y': 0,
 
     'quartermagnet_size_xy': [58/2, 30],
-    'magnet_material': rad.MatLin([0.05, 0.15], [0, 0, 1.30]),
+    'magnet_material': None, # rad.MatLin([0.05, 0.15], [0, 0, 1.30]), created by get_ivu
     'magnet_divisions': [5, 5, 5],
     'magnet_chamfer_corner': 1,
     'magnet_chamfer_outerside': 0,
@@ -35,6 +32,8 @@ ivu18args = dict({
     'girder_top_roll_rad': 0,
     'girder_bot_roll_rad': 0,
     'returnobject': 0,
+    'symmetry': True,
+    'periodic': False,
 
     'debug': False,
 
@@ -0,0 +1,25 @@
+# Segmentation convergence study for the IVU18 geometry
+# Run: python ivu18_segmentation.py [relative Beff tolerance]
+
+import sys
+
+import radiamodels.ivu as ri
+import radiamodels.segmentation as rseg
+from ivu18_defaults import ivu18args
+
+TOLERANCE = float(sys.argv[1]) if len(sys.argv) > 1 else 1e-3
+
+ivu18args.update({
+    'nhalfperiods': 15,
+})
+
+study = rseg.study_segmentation(ri.get_ivu, tolerance=TOLERANCE, debug=True, **ivu18args)
+
+check = study['check']
+print('recommended segmentation:')
+for k, v in study['recommended'].items():
+    print(f'    {k}: {v}')
+print(f"Beff {check['beff']:.5f} T, relative to the finest {check['dbeff']:.2e}, "
+      f"{check['nelements']} elements, {check['memory']/1e9:.3f} GB, {check['time']:.1f} s")
+if not study['converged_all']:
+    print('Not converged for', [k for k, c in study['converged'].items() if not c] or 'the combined check')
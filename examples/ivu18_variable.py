@@ -1,31 +1,17 @@
+# Run: srun -n 24 python ivu18_variable.py  (or just python ivu18_variable.py for a local process pool)
+
 import radia as rad
 import radiamodels.ivu as ri
 import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.sweep as rs
 from ivu18_defaults import ivu18args
 
 import numpy as np
-import matplotlib.pyplot as plt
-import time
-import pickle
-import os.path
-
-# MPI imports
-from mpi4py import MPI
-from mpi4py.MPI import ANY_SOURCE
-
-# Common MPI communication, rank, size
-comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
-size = comm.Get_size()
-
-show=False
-if not show:
-    import matplotlib
-    matplotlib.use('Agg')
 
 
-# Conversion factors
-TMM2GCM = 1e3
+# Number of values to scan, independent of the number of MPI ranks or processes
+NPOINTS = 48
 
 # default is just variable name unless name added/defined
 name = None
@@ -43,64 +29,50 @@ ivu18args.update({
 #variable = 'half_pole_size'
 # pole height
 #name = variable + '_y'
-#values = np.linspace(10, ivu18args['quartermagnet_size_xy'][1], size)
-#value = [ivu18args[variable][0], values[rank], ivu18args[variable][2]]
+#values = np.linspace(10, ivu18args['quartermagnet_size_xy'][1], NPOINTS)
+#settings = [[ivu18args[variable][0], v, ivu18args[variable][2]] for v in values]
 # pole width
 #name = variable + '_x'
-#values = np.linspace(10, ivu18args['quartermagnet_size_xy'][0], size)
-#value = [values[rank], ivu18args[variable][1], ivu18args[variable][2]]
+#values = np.linspace(10, ivu18args['quartermagnet_size_xy'][0], NPOINTS)
+#settings = [[v, ivu18args[variable][1], ivu18args[variable][2]] for v in values]
 
 #variable = 'pole_chamfer_shortedge'
-#values = np.linspace(0, 10, size)
-#value = values[rank]
+#values = np.linspace(0, 10, NPOINTS)
 
 #variable = 'pole_chamfer_longedge'
-#values = np.linspace(0, ivu18args['half_pole_size'][2]/2, size)
-#value = values[rank]
+#values = np.linspace(0, ivu18args['half_pole_size'][2]/2, NPOINTS)
 
 #variable = 'half_pole_size'
 #name = variable + '_z'
-#values = np.linspace(1, 5, size)
-#value = [ivu18args[variable][0], ivu18args[variable][1], values[rank]]
+#values = np.linspace(1, 5, NPOINTS)
+#settings = [[ivu18args[variable][0], ivu18args[variable][1], v] for v in values]
 
 #variable = 'magnet_chamfer_gapside'
-#values = np.linspace(0, (ivu18args['period']/2-ivu18args['half_pole_size'][2])/4, size)
-#value = values[rank]
+#values = np.linspace(0, (ivu18args['period']/2-ivu18args['half_pole_size'][2])/4, NPOINTS)
 
 #variable = 'quartermagnet_size_xy'
 #name = variable + '_x'
-#values = np.linspace(ivu18args['half_pole_size'][0], 2*ivu18args['half_pole_size'][0], size)
-#value = [values[rank], ivu18args[variable][1]]
+#values = np.linspace(ivu18args['half_pole_size'][0], 2*ivu18args['half_pole_size'][0], NPOINTS)
+#settings = [[v, ivu18args[variable][1]] for v in values]
 
 #variable = 'quartermagnet_size_xy'
 #name = variable + '_y'
-#values = np.linspace(ivu18args['half_pole_size'][1], 3*ivu18args['half_pole_size'][1], size)
-#value = [ivu18args[variable][0], values[rank]]
-
-#variable = 'pole_chamfer_shortedge'
-#name = variable + '_2'
-#values = np.linspace(0, 10, size)
-#value = values[rank]
-
-#variable = 'half_pole_size'
-#name = variable + '_z2'
-#values = np.linspace(1, 5, size)
-#value = [ivu18args[variable][0], ivu18args[variable][1], values[rank]]
+#values = np.linspace(ivu18args['half_pole_size'][1], 3*ivu18args['half_pole_size'][1], NPOINTS)
+#settings = [[ivu18args[variable][0], v] for v in values]
 
 variable = 'pole_offset_y'
-values = np.linspace(0, 5, size)
-value = values[rank]
+values = np.linspace(0, 5, NPOINTS)
+settings = None
 
 if name is None:
     name = variable
-pickle_name = 'ivu18_'+name+'.p'
-if os.path.exists(pickle_name):
-    if rank == 0:
-        print('ERROR: output file already exists:', pickle_name)
-    exit(0)
+if settings is None:
+    settings = values
+# Results are appended to this columnar store as they come in, read it with plot_values.py
+store_name = 'ivu18_'+name
+# Each finished point is written here, rerunning the script after a crash only runs what is missing
+checkpoint_name = 'ivu18_'+name+'.jsonl'
 
-# Update the parameter of interest
-ivu18args[variable] = value
 
 if False: # for fast testing only
     ivu18args.update({
@@ -109,54 +81,41 @@ if False: # for fast testing only
         'magnet_divisions' : [1, 1, 1],
         })
 
-undulator = ri.get_ivu(**ivu18args)
-rad.Solve(undulator, 0.0003, 1000)
-
-
-# get some basic ID info
-PERIOD = ivu18args['period']
-NHALFPERIODS = ivu18args['nhalfperiods']
-
-# Just part to take effective field from
-zstart = -PERIOD + PERIOD * NHALFPERIODS%4/4
-zstop = zstart + 2 * PERIOD
-
-# effective field from 0 and +/- 5mm
-ZE = np.linspace(zstart, zstop, 5001)
-BE0 = [rad.Fld(undulator, 'b', [0, 0, z]) for z in ZE]
-BEP = [rad.Fld(undulator, 'b', [5, 0, z]) for z in ZE]
-
-ByEffMag0 = ru.get_beff(ZE, [b[1] for b in BE0], 2)
-ByEffMagP = ru.get_beff(ZE, [b[1] for b in BEP], 2)
-#print(f'Beff 0: {ByEffMag0:.3f}  +: {ByEffMagP:.3f}')
-#print(f'Keff 0: {ru.b2k_mm(ByEffMag0, PERIOD):.3f}  +: {ru.b2k_mm(ByEffMagP, PERIOD):.3f}')
-
-thisdata = dict({
-    'value': values[rank],
-    'ByEffMag0': ByEffMag0,
-    'ByEffMagP': ByEffMagP,
-    'ivu18args': ivu18args
-    })
-
 
-value_vs_beff = [thisdata]
+def get_beff_0p (builder, **params):
+    """Solve and get the effective field at x=0 and x=+5mm"""
+    undulator = builder(**params)
+    rad.Solve(undulator, 0.0003, 1000)
 
-if rank == 0:
-    # Now wait and collect data from all other processes when it comes in
-    for i in range(1, size):
-        # Get incoming data
-        data = comm.recv(source=ANY_SOURCE)
-        value_vs_beff.append(data)
+    # get some basic ID info
+    PERIOD = params['period']
+    NHALFPERIODS = params['nhalfperiods']
 
-else:
-    # Send results back to rank 0
-    comm.send(thisdata, dest=0)
-    exit(0)
+    # Just part to take effective field from
+    zstart = -PERIOD + PERIOD * NHALFPERIODS%4/4
+    zstop = zstart + 2 * PERIOD
 
+    # effective field from 0 and +/- 5mm
+    ZE = np.linspace(zstart, zstop, 5001)
+    BE0 = rf.get_field_z(undulator, ZE)
+    BEP = rf.get_field_z(undulator, ZE, x=5)
 
-value_vs_beff.sort(key=lambda x: x['value'])
+    return {
+        'ByEffMag0': ru.get_beff(ZE, BE0[:, 1], 2),
+        'ByEffMagP': ru.get_beff(ZE, BEP[:, 1], 2),
+    }
 
-data = [variable, value_vs_beff]
-pickle.dump(data, open(pickle_name, 'wb'))
 
+if __name__ == '__main__':
+    points = [{variable: s} for s in settings]
 
+    results = rs.run_sweep(
+        ri.get_ivu,
+        points,
+        base_params=ivu18args,
+        func=get_beff_0p,
+        checkpoint=checkpoint_name,
+        store=store_name,
+        store_meta={'variable': variable, 'name': name},
+        debug=True,
+    )
@@ -1,6 +1,7 @@
 import radia as rad
 import radiamodels.ivu as ri
 import radiamodels.util as ru
+import radiamodels.field as rf
 from ivu18_defaults import ivu18args
 
 import numpy as np
@@ -71,12 +72,12 @@ zstop = zstart + 2 * PERIOD
 
 # effective field from 0 and +/- 5mm
 ZE = np.linspace(zstart, zstop, 5001)
-BE0 = [rad.Fld(undulator, 'b', [0, 0, z]) for z in ZE]
-BEP = [rad.Fld(undulator, 'b', [5, 0, z]) for z in ZE]
+BE0 = rf.get_field_z(undulator, ZE)
+BEP = rf.get_field_z(undulator, ZE, x=5)
 
 if rank == 0:
-    ByEffMag0 = ru.get_beff(ZE, [b[1] for b in BE0], 2)
-    ByEffMagP = ru.get_beff(ZE, [b[1] for b in BEP], 2)
+    ByEffMag0 = ru.get_beff(ZE, BE0[:, 1], 2)
+    ByEffMagP = ru.get_beff(ZE, BEP[:, 1], 2)
     print(f'Beff 0: {ByEffMag0:.3f}  +: {ByEffMagP:.3f}')
     print(f'Keff 0: {ru.b2k_mm(ByEffMag0, PERIOD):.3f}  +: {ru.b2k_mm(ByEffMagP, PERIOD):.3f}')
 
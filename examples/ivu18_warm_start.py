@@ -0,0 +1,29 @@
+# Relaxation iterations of a gap sweep of IVU18 with and without warm start
+# Run: python ivu18_warm_start.py [number of gaps]
+
+import sys
+import time
+
+import numpy as np
+
+import radiamodels.ivu as ri
+import radiamodels.sweep as rs
+from ivu18_defaults import ivu18args
+
+NGAPS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+points = rs.make_grid(gap=np.linspace(5, 15, NGAPS))
+
+niter = {}
+for warm_start in [False, True]:
+    t0 = time.time()
+    # one process so every point follows its neighbour
+    results = rs.run_sweep(ri.get_ivu, points, base_params=ivu18args, nworkers=1, warm_start=warm_start)
+    # last entry of the solve result is the number of iterations
+    niter[warm_start] = np.array([int(r['solve'][-1]) for r in results])
+    beff = np.array([r['beff'] for r in results])
+    print(f'warm_start={warm_start!s:5s} {time.time() - t0:.1f} s iterations {niter[warm_start].tolist()}')
+    print(f'    beff {np.round(beff, 5).tolist()}')
+
+print(f'iterations cold {niter[False].sum()} warm {niter[True].sum()}, '
+      f'{1 - niter[True].sum() / niter[False].sum():.0%} fewer')
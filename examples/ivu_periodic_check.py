@@ -0,0 +1,76 @@
+# Compare get_ivu with the periodic body repeated by rad.TrfMlt against one copy per module
+# Run: python ivu_periodic_check.py [nhalfperiods] [relative tolerance] [coarse]
+# Uses the segmentation of ivu18_defaults unless coarse is given, and reports Beff and the
+# field integrals of both models.  Exits with status 1 if the field on axis, Beff or the
+# integrals differ by more than the tolerance
+
+import sys
+import time
+
+import radia as rad
+import radiamodels.ivu as ri
+import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.integrals as rint
+from ivu18_defaults import ivu18args
+
+import numpy as np
+
+NHALFPERIODS = int(sys.argv[1]) if len(sys.argv) > 1 else 21
+TOLERANCE = float(sys.argv[2]) if len(sys.argv) > 2 else 1e-3
+COARSE = len(sys.argv) > 3 and sys.argv[3] == 'coarse'
+
+ivu18args.update({
+    'nhalfperiods': NHALFPERIODS,
+})
+if COARSE:
+    ivu18args.update({
+        'pole_body_divisions': [1, 1, 1],
+        'pole_tip_divisions': [1, 1, 1],
+        'magnet_divisions': [1, 1, 1],
+    })
+PERIOD = ivu18args['period']
+NPERIODS = 2
+
+Z = np.linspace(-0.6*PERIOD*NHALFPERIODS - 100, 0.6*PERIOD*NHALFPERIODS + 100, 4001)
+ZBEFF = np.linspace(-NPERIODS*PERIOD/2, NPERIODS*PERIOD/2, 500, endpoint=False)
+
+results = {}
+for periodic in [False, True]:
+    rad.UtiDelAll()
+    ru.clear_materials()
+
+    t0 = time.time()
+    undulator = ri.get_ivu(**dict(ivu18args, periodic=periodic))
+    t_build = time.time() - t0
+
+    t0 = time.time()
+    res = rad.Solve(undulator, 0.0001, 10000)
+    t_solve = time.time() - t0
+
+    B = rf.get_field_z(undulator, Z)
+    I1 = rint.cumtrapz(B[:, 1], Z)
+    results[periodic] = {
+        'b': B,
+        'beff': float(ru.get_beff(ZBEFF, rf.get_field_z(undulator, ZBEFF)[:, 1], NPERIODS)),
+        'i1y': I1[-1],
+        'i2y': rint.trapz(I1, Z),
+    }
+    r = results[periodic]
+    print(f'periodic={periodic!s:5s} build {t_build:.2f} s solve {t_solve:.2f} s ({int(res[-1])} iterations) '
+          f'model dump {len(rad.UtiDmp(undulator, "bin"))} bytes')
+    print(f"    beff {r['beff']:.6f} T  I1y {r['i1y']:.5f} T mm  I2y {r['i2y']:.3f} T mm^2")
+
+R0, R1 = results[False], results[True]
+diff = np.max(np.abs(R1['b'] - R0['b'])) / np.max(np.abs(R0['b']))
+dbeff = abs(R1['beff'] / R0['beff'] - 1)
+# integrals relative to the integral of one pole, as they are close to zero
+pole = np.max(np.abs(rint.cumtrapz(R0['b'][:, 1], Z)))
+di1 = abs(R1['i1y'] - R0['i1y']) / pole
+di2 = abs(R1['i2y'] - R0['i2y']) / (pole * PERIOD)
+print(f'max |dB| / max |B| = {diff:.2e}, dBeff / Beff = {dbeff:.2e}, '
+      f'dI1 / I1 pole = {di1:.2e}, dI2 / (I1 pole period) = {di2:.2e}')
+
+if max(diff, dbeff, di1, di2) > TOLERANCE:
+    print('Over the tolerance of', TOLERANCE)
+    exit(1)
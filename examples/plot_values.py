@@ -1,31 +1,39 @@
 import sys
-import pickle
+import numpy as np
 import matplotlib.pyplot as plt
+import radiamodels.store as rst
 
 # name from input
-pickle_name = sys.argv[1]
-
-# unpickle the data
-variable, value_vs_beff = pickle.load(open(pickle_name, 'rb'))
-
-# Grab values of interest
-values = [data['value'] for data in value_vs_beff]
-ByEffMag0 = [data['ByEffMag0'] for data in value_vs_beff]
-ByEffMagP = [data['ByEffMagP'] for data in value_vs_beff]
+store_name = sys.argv[1]
+
+# only the columns needed are read
+meta = rst.read_meta(store_name)
+variable = meta['variable']
+data = rst.read(store_name, [variable, 'ByEffMag0', 'ByEffMagP'])
+
+# Grab values of interest, for list parameters the component which changes
+values = data[variable]
+if values.ndim > 1:
+    values = values[:, np.argmax(np.ptp(values, axis=0))]
+order = np.argsort(values)
+values = values[order]
+ByEffMag0 = data['ByEffMag0'][order]
+ByEffMagP = data['ByEffMagP'][order]
 
 # Find the max Beff
-mymax = max(ByEffMag0)
-myidx = ByEffMag0.index(mymax)
+myidx = int(np.argmax(ByEffMag0))
+mymax = ByEffMag0[myidx]
 
 # Print all arguments used for max Beff
-infos = value_vs_beff[myidx]['ivu18args']
+infos = dict(meta['base_params'])
+infos[variable] = data[variable][order][myidx].tolist()
 for key in infos:
     print('    \'' + key + '\':', str(infos[key]) + ',')
 
 print('\nParameter varied:', variable, '\n')
 print(f'beff max is {mymax:.3f} at {values[myidx]:.3f}')
 
-period = value_vs_beff[0]['ivu18args']['period']
+period = meta['base_params']['period']
 print(f'Keff mas is {0.09336*mymax*period:.3f}')
 
 plt.figure()
@@ -37,4 +45,3 @@ plt.plot(values, ByEffMagP, label='Beff+')
 plt.axvline(values[myidx], label=f'Beff Max {mymax:.3f} at {values[myidx]:.3f}')
 plt.legend()
 plt.show()
-
@@ -0,0 +1,299 @@
+import os
+import re
+import time
+import json
+import inspect
+import hashlib
+import numpy as np
+
+import radia as rad
+import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.magnetization as rm
+import radiamodels.ivu_center as ric
+
+
+# Bump when the content or meaning of cached results changes, or a builder default changes
+CACHE_VERSION = 4
+
+# Default location and size of the on-disk cache, RADIAMODELS_CACHE overrides the location
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'radiamodels')
+DEFAULT_MAX_BYTES = 1024**3
+
+# Parameters which do not change the solved model
+IGNORED_PARAMS = ('debug',)
+
+
+def get_cache_dir (cache_dir=None):
+    """Get (and create) the cache directory"""
+    if cache_dir is None:
+        cache_dir = os.environ.get('RADIAMODELS_CACHE', DEFAULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def describe_material (matid):
+    """
+    Get a description of a radia material which does not depend on the radia index.
+    Radia integer IDs are only meaningful inside the process that created them.
+    """
+    key = ru.get_material_key(matid)
+    if key is not None:
+        if key[0] == 'MatSatIsoTab':
+            # the table content, not the path of the file it came from
+            key = (key[0], hashlib.sha256(ru.read_bh_table(key[1]).tobytes()).hexdigest())
+        return repr(key)
+    dump = rad.UtiDmp(matid, 'asc')
+    return ' '.join(re.sub(r'Index\s+\d+\s*:?', '', dump).split())
+
+
+def canonicalize (value, key=''):
+    """
+    Convert a parameter (dict) to a canonical json-able form.
+
+    Materials (keys ending in 'material' with integer values) are replaced by their description,
+    numpy types become python types and floats are rounded to 12 significant digits so that
+    eg 38/2 and 19.0 give the same hash.
+    """
+    if isinstance(value, dict):
+        return {
+            str(k): canonicalize(v, str(k))
+            for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))
+            if k not in IGNORED_PARAMS
+        }
+    if key.endswith('material') and isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return {'material': describe_material(int(value))}
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(v) for v in value]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(f'{float(value):.12g}')
+    if callable(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    return value
+
+
+def resolve_params (builder, params):
+    """
+    params with the default of every builder argument which is not given, so the hash changes
+    when a default of the builder changes.  params which are not all arguments of builder
+    (eg a model hash) are returned as they are.
+    """
+    try:
+        bound = inspect.signature(builder).bind_partial(**params)
+    except (TypeError, ValueError):
+        return params
+    bound.apply_defaults()
+
+    resolved = {}
+    for name, value in bound.arguments.items():
+        kind = bound.signature.parameters[name].kind
+        if kind == inspect.Parameter.VAR_KEYWORD:
+            resolved.update(value)
+        elif kind != inspect.Parameter.VAR_POSITIONAL:
+            resolved[name] = value
+    return resolved
+
+
+def param_hash (builder, params, precision=None, maxiter=None, **extra):
+    """
+    Hash of a model built by builder(**params) and solved with precision and maxiter
+
+    args:
+        builder: function building the radia model, eg get_ivu
+        params: dict of parameters passed to builder, the defaults of the others are included
+        precision: solve precision
+        maxiter: maximum solve iterations
+        extra: anything else the result depends on, eg sampling settings
+    returns:
+        hex digest string
+    """
+    description = canonicalize({
+        'version': CACHE_VERSION,
+        'builder': builder,
+        'params': resolve_params(builder, params),
+        'precision': precision,
+        'maxiter': maxiter,
+        'extra': extra,
+    })
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def model_hash (obj):
+    """
+    Hash of the current state of a radia object, geometry, materials and magnetization included,
+    so a solved model has a different hash from the same model before solving
+    """
+    return hashlib.sha256(rad.UtiDmp(obj, 'bin')).hexdigest()
+
+
+def _path (key, cache_dir=None):
+    return os.path.join(get_cache_dir(cache_dir), key + '.npz')
+
+
+def load (key, cache_dir=None):
+    """
+    Load a cached result
+
+    returns:
+        dict of results or None if key is not in the cache
+    """
+    path = _path(key, cache_dir)
+    try:
+        with np.load(path) as data:
+            result = {k: (v[()] if v.ndim == 0 else v) for k, v in data.items()}
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+
+    # Mark as recently used for the LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return result
+
+
+def save (key, result, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Save a dict of results (scalars and arrays) in the cache and evict old entries if needed
+    """
+    path = _path(key, cache_dir)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as fo:
+        np.savez(fo, **{k: np.asarray(v) for k, v in result.items()})
+    os.replace(tmp, path)
+
+    evict(cache_dir, max_bytes)
+    return
+
+
+def evict (cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Remove least recently used entries until the cache is at most max_bytes
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npz'):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+    return
+
+
+def clear (cache_dir=None):
+    """Remove all entries from the cache"""
+    evict(cache_dir, max_bytes=0)
+    return
+
+
+def get_param (builder, params, name):
+    """Get a parameter from params, or the builder default if it is not given"""
+    if name in params:
+        return params[name]
+    return inspect.signature(builder).parameters[name].default
+
+
+def solve_beff (builder, precision=0.0001, maxiter=10000, nperiods=2, npoints=500, x=0, y=0, sample=False,
+                warm_start=False, **params):
+    """
+    Build a model with builder(**params), solve it, and get Beff, Bmax and the odd harmonics
+    from the field over nperiods centered on z=0.  The model is deleted afterwards.
+
+    args:
+        builder: function building the radia model, eg get_ivu
+        precision: solve precision
+        maxiter: maximum solve iterations
+        nperiods: number of periods in the Beff region
+        npoints: number of z points in the Beff region
+        x, y: transverse position of the field samples
+        sample: if True also return the sampled field
+        warm_start: start the relaxation from the last model solved with warm_start in this
+                    process if it has the same elements (see magnetization.warm_start)
+        params: passed to builder
+    returns:
+        dict with beff, bmax, bn, solve (radia solve result), time and optionally z and b
+    """
+    period = get_param(builder, params, 'period')
+
+    t0 = time.time()
+    und = builder(**params)
+    if warm_start and rm.warm_start(und):
+        # rad.Solve would start from zero magnetization again
+        res = rm.relax(und, precision, maxiter)
+    else:
+        res = rad.Solve(und, precision, maxiter)
+    t1 = time.time()
+    if warm_start:
+        rm.remember(und)
+
+    Z = np.linspace(-nperiods*period/2, nperiods*period/2, npoints, endpoint=False)
+    B = rf.get_field_z(und, Z, x=x, y=y)
+    # a sweep worker builds hundreds of models, free each one once its field is taken
+    rm.delete_model(und)
+
+    result = {
+        'beff': float(ru.get_beff(Z, B[:, 1], nperiods)),
+        'bmax': float(np.max(np.abs(B[:, 1]))),
+        'bn': np.asarray(ru.get_beff(Z, B[:, 1], nperiods, harmonics=True), dtype=float),
+        'solve': np.asarray(res, dtype=float),
+        'time': t1 - t0,
+    }
+    if sample:
+        result['z'] = Z
+        result['b'] = B
+    return result
+
+
+def cached_solve_beff (builder, precision=0.0001, maxiter=10000, nperiods=2, npoints=500, x=0, y=0,
+                       sample=False, warm_start=False, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, **params):
+    """
+    Same as solve_beff but results are looked up in and saved to the on-disk cache.
+    warm_start only changes the starting point of the relaxation and is not part of the key.
+    """
+    key = param_hash(builder, params, precision, maxiter, nperiods=nperiods, npoints=npoints, x=x, y=y)
+
+    result = load(key, cache_dir)
+    if result is not None and (not sample or 'b' in result):
+        return result
+
+    result = solve_beff(builder, precision, maxiter, nperiods, npoints, x, y, sample=sample, warm_start=warm_start, **params)
+    save(key, result, cache_dir, max_bytes)
+    return result
+
+
+def cached_get_solve_beff (cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, **params):
+    """
+    Cached version of ivu_center.get_solve_beff
+
+    returns:
+        [Beff, Bmax, Bns]
+    """
+    # get_ivu_center as the builder so its defaults are in the key, get_solve_beff only takes
+    # **params, and the function for its fixed sampling
+    key = param_hash(ric.get_ivu_center, params, ric.SOLVE_PRECISION, ric.SOLVE_MAXITER, func=ric.get_solve_beff)
+    result = load(key, cache_dir)
+    if result is None:
+        beff, bmax, bn = ric.get_solve_beff(**params)
+        result = {'beff': beff, 'bmax': bmax, 'bn': np.asarray(bn)}
+        save(key, result, cache_dir, max_bytes)
+
+    return [float(result['beff']), float(result['bmax']), np.asarray(result['bn']).tolist()]
@@ -1,7 +1,22 @@
+import time
+import inspect
 import radia as rad
+import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.layout as rl
+import radiamodels.magnetization as rm
 import numpy as np
 
 
+# Girders moved by +phase and by -phase in each phase mode
+PHASE_MODES = {
+    'tibo': (['ti', 'bo'], []),
+    'tobi': (['to', 'bi'], []),
+    'ap-tibo': (['ti'], ['bo']),
+    'ap-tobi': (['to'], ['bi']),
+}
+
+
 def get_epu (
     nhalfperiods=10,
     period=49,
@@ -14,8 +29,29 @@ def get_epu (
     Br=1.25,
     phase=0,
     phase_mode='TIBO',
+    symmetric=True,
+    layout=None,
+    return_girders=False,
     debug=False,
 ):
+    """
+    Get an EPU with four girders ti, to, bi, bo (top/bottom, inner/outer)
+
+    With symmetric=True girders related by symmetry are not built explicitly but represented
+    by radia symmetries, which are also imposed in the relaxation: to is the x mirror of ti
+    and the bottom girders are the top ones rotated by pi about z with the magnetization
+    inverted.  A phase breaks the x mirror, in the anti-parallel modes it breaks the rotation
+    too and the full device is built as with symmetric=False.
+
+    layout is an optional girder layout (see radiamodels.layout) replacing the default one
+    of ti, eg a perturbed one.
+
+    With return_girders=True all four girders are built explicitly and (undulator, girders,
+    phase_girders) is returned, girders a dict of the radia containers ti, to, bi, bo, each
+    placed by taper and gap in the frame of the device (before tilt and elevation), and
+    phase_girders a dict of the girders inside them, by the same names, which the phase moves.
+    So they can be moved in place (see move_gap, move_phase and scan_phase) or used for forces.
+    """
     # First magnet will be half length vertical, last will be half length vertical
 
     end_outer_length = 3 * period / 20
@@ -37,15 +73,8 @@ def get_epu (
     extrahalf_offset = period / 4 if nhalfperiods % 2 else 0
 
     # Magnet material
-    magnet_material = rad.MatStd('NdFeB', Br)
-
-    magnet_strengths = [
-        [0,  0, +1],
-        [0, -1,  0],
-        [0,  0, -1],
-        [0, +1,  0],
+    magnet_material = ru.get_material_std('NdFeB', Br)
 
-    ]
     magnet_colors = [
         [0, 1, 1],
         [1, 0, 1],
@@ -53,45 +82,57 @@ def get_epu (
         [0.5, 0, 0.5],
 
     ]
-    magnet_color = [0, 0, 1]
-
-    girder_ti = rad.ObjCnt([])
-    nmagnets = nhalfperiods * 2 + 1
-    for i in range(-2, nmagnets):
-        this_magnet_strength = magnet_strengths[i % 4]
-        this_magnet_color = magnet_colors[i % 4]
-        this_magnet_center = [0, 0, -length / 2 + end_outer_length + end_inner_length + i * magnet_size[2] + magnet_size[2] / 2]
-        this_magnet_size = magnet_size
-        if i == -2:
-            this_magnet_center = [0, 0, -length / 2 + end_outer_length / 2]
-            this_magnet_size = magnet_size[0:2] + [end_outer_length]
-        elif i == -1:
-            this_magnet_center = [0, 0, -length / 2 + end_outer_length + end_inner_length / 2]
-            this_magnet_size = magnet_size[0:2] + [magnet_size[2]/2]
-        elif i == nmagnets - 2:
-            this_magnet_center = [0, 0, length / 2 - end_outer_length - end_inner_length / 2]
-            this_magnet_size = magnet_size[0:2] + [end_inner_length]
-            # print('end inner:', this_magnet_center, this_magnet_size)
-        elif i == nmagnets - 1:
-            this_magnet_center = [0, 0, length / 2 - end_outer_length / 2]
-            this_magnet_size = magnet_size[0:2] + [end_outer_length]
-            # print('end outer:', this_magnet_center, this_magnet_size)
-
-        # print('mag:', this_magnet_strength[1:], this_magnet_center[2], this_magnet_size[2])
-
-        magnet = rad.ObjFullMag(
-            this_magnet_center,
-            this_magnet_size,
-            this_magnet_strength,
-            magnet_divisions,
-            girder_ti,
-            magnet_material,
-            this_magnet_color,
-        )
+
+    # Layout of one girder, then all blocks built in one go
+    if layout is None:
+        layout = rl.get_girder_layout(nhalfperiods, period, magnet_size_xy, colors=magnet_colors)
+    girder_ti = rl.build_layout(layout, {'NdFeB': magnet_material}, magnet_divisions)
 
     # Move ti
     rad.TrfOrnt(girder_ti, rad.TrfTrsl([magnet_size[0]/2, magnet_size[1]/2, 0]))
-    
+
+    pm = phase_mode.lower()
+    if pm not in PHASE_MODES:
+        raise ValueError(f'unknown phase_mode {phase_mode}, one of {list(PHASE_MODES)}')
+
+    if symmetric and not return_girders and (phase == 0 or pm in ['tibo', 'tobi']):
+        if debug: print('fast symmetric')
+
+        if phase == 0:
+            # ti -> to
+            rad.TrfZerPerp(girder_ti, [0, 0, 0], [1, 0, 0])
+            girder_top = rad.ObjCnt([girder_ti])
+        else:
+            # Copy ti -> to, the phase moves one of them
+            girder_to = rad.ObjDpl(girder_ti)
+            rad.TrfOrnt(girder_to, rad.TrfPlSym([0, 0, 0], [-1, 0, 0]))
+            rad.TrfOrnt(girder_ti if pm == 'tibo' else girder_to, rad.TrfTrsl([0, 0, phase]))
+            girder_top = rad.ObjCnt([girder_ti, girder_to])
+
+        # Adjust for taper
+        phi_taper = np.arcsin(taper_mm_per_mm/2)
+        rad.TrfOrnt(girder_top, rad.TrfRot([0, 0, 0], [-1, 0, 0], phi_taper))
+
+        # Adjust for gap
+        rad.TrfOrnt(girder_top, rad.TrfTrsl([0, +gap/2, 0]))
+
+        # top -> bottom, ti -> bo and to -> bi
+        rad.TrfMlt(girder_top, rad.TrfCmbL(rad.TrfRot([0, 0, 0], [0, 0, 1], np.pi), rad.TrfInv()), 2)
+
+        # Build undulator, outside of the symmetry so tilt and elevation move the whole device
+        undulator = rad.ObjCnt([girder_top])
+
+        # Adjust for tilt
+        phi_tilt = np.arcsin(tilt_mm_per_mm)
+        rad.TrfOrnt(undulator, rad.TrfRot([0, 0, 0], [1, 0, 0], phi_tilt))
+
+        # Adjust for elevation
+        rad.TrfOrnt(undulator, rad.TrfTrsl([0, 0, elevation]))
+
+        return undulator
+
+    if debug: print('Nonsymmetric and will take longer to compute')
+
     # Copy ti -> to
     girder_to = rad.ObjDpl(girder_ti)
     rad.TrfOrnt(girder_to, rad.TrfPlSym([0, 0, 0], [-1, 0, 0]))
@@ -105,37 +146,28 @@ def get_epu (
     girder_bi = rad.ObjDpl(girder_bo)
     rad.TrfOrnt(girder_bi, rad.TrfPlSym([0, 0, 0], [+1, 0, 0]))
 
-    # Phase modes
-    pm = phase_mode.lower()
-    if phase != 0:
-        if pm == 'tibo':
-            rad.TrfOrnt(girder_ti, rad.TrfTrsl([0, 0, phase]))
-            rad.TrfOrnt(girder_bo, rad.TrfTrsl([0, 0, phase]))
-        elif pm == 'tobi':
-            rad.TrfOrnt(girder_to, rad.TrfTrsl([0, 0, phase]))
-            rad.TrfOrnt(girder_bi, rad.TrfTrsl([0, 0, phase]))
-        elif pm == 'ap-tibo':
-            rad.TrfOrnt(girder_ti, rad.TrfTrsl([0, 0, +phase]))
-            rad.TrfOrnt(girder_bo, rad.TrfTrsl([0, 0, -phase]))
-        elif pm == 'ap-tobi':
-            rad.TrfOrnt(girder_to, rad.TrfTrsl([0, 0, +phase]))
-            rad.TrfOrnt(girder_bi, rad.TrfTrsl([0, 0, -phase]))
-
-    # Make top and bottom girders
-    girder_top = rad.ObjCnt([girder_ti, girder_to])
-    girder_bot = rad.ObjCnt([girder_bi, girder_bo])
-
-    # Adjust for taper
+    phase_girders = {'ti': girder_ti, 'to': girder_to, 'bi': girder_bi, 'bo': girder_bo}
+
+    # Each girder in its own container for taper and gap, so it is complete in the frame of
+    # the device and the phase can still be moved inside it
     phi_taper = np.arcsin(taper_mm_per_mm/2)
-    rad.TrfOrnt(girder_top, rad.TrfRot([0, 0, 0], [-1, 0, 0], phi_taper))
-    rad.TrfOrnt(girder_bot, rad.TrfRot([0, 0, 0], [+1, 0, 0], phi_taper))
+    girders = {}
+    for name in ['ti', 'to', 'bi', 'bo']:
+        sign = +1 if name[0] == 't' else -1
+        girders[name] = rad.ObjCnt([phase_girders[name]])
+
+        # Adjust for taper
+        rad.TrfOrnt(girders[name], rad.TrfRot([0, 0, 0], [-sign, 0, 0], phi_taper))
+
+        # Adjust for gap
+        rad.TrfOrnt(girders[name], rad.TrfTrsl([0, sign*gap/2, 0]))
 
-    # Adjust for gap
-    rad.TrfOrnt(girder_top, rad.TrfTrsl([0, +gap/2, 0]))
-    rad.TrfOrnt(girder_bot, rad.TrfTrsl([0, -gap/2, 0]))
+    # Phase modes
+    if phase != 0:
+        move_phase(phase_girders, phase, pm)
 
     # Build undulator
-    undulator = rad.ObjCnt([girder_top, girder_bot])
+    undulator = rad.ObjCnt([girders[name] for name in ['ti', 'to', 'bi', 'bo']])
 
     # Adjust for tilt
     phi_tilt = np.arcsin(tilt_mm_per_mm)
@@ -144,4 +176,114 @@ def get_epu (
     # Adjust for elevation
     rad.TrfOrnt(undulator, rad.TrfTrsl([0, 0, elevation]))
 
+    if return_girders:
+        return undulator, girders, phase_girders
+
     return undulator
+
+
+def move_phase (phase_girders, dphase, mode):
+    """
+    Move the phase_girders of get_epu(..., return_girders=True) in place by dphase in a phase
+    mode.  They are inside the containers placed by taper and gap, as the phase in get_epu.
+    """
+    plus, minus = PHASE_MODES[mode.lower()]
+    for name in plus:
+        rad.TrfOrnt(phase_girders[name], rad.TrfTrsl([0, 0, +dphase]))
+    for name in minus:
+        rad.TrfOrnt(phase_girders[name], rad.TrfTrsl([0, 0, -dphase]))
+    return
+
+
+def move_gap (girders, dgap):
+    """Open the gap of girders from a builder with return_girders=True in place by dgap"""
+    for name, girder in girders.items():
+        sign = +1 if name[0] == 't' else -1
+        rad.TrfOrnt(girder, rad.TrfTrsl([0, sign*dgap/2, 0]))
+    return
+
+
+def scan_phase (
+    phases,
+    mode = 'tibo',
+    gaps = None,
+    precision = 0.0001,
+    maxiter = 10000,
+    nperiods = 2,
+    npoints = 500,
+    analyze = None,
+    debug = False,
+    **epu_params,
+):
+    """
+    Solve get_epu(**epu_params) at each phase in phases, and each gap in gaps if given.  The
+    four girders are built only once and moved in place between points, and each relaxation
+    after the first starts from the magnetization of the previous point (magnetization.relax,
+    rad.Solve would start from zero).  For a gap and phase grid the phases
+    are run back and forth so consecutive points are always neighbours.
+
+    args:
+        phases: list of phases in mm
+        mode: phase mode, one of PHASE_MODES
+        gaps: optional list of gaps in mm, otherwise the gap of epu_params
+        precision: solve precision
+        maxiter: maximum solve iterations per point
+        nperiods: number of periods around z=0 used for Beff
+        npoints: number of z points used for Beff
+        analyze: optional function analyze(undulator, gap, phase) returning a dict of extra results
+        debug: print progress
+        epu_params: passed to get_epu (phase, phase_mode and return_girders are ignored)
+    returns:
+        dict of arrays over the points: gap, phase, bxeff, byeff, kx, ky, niter, time and
+        anything returned by analyze
+    """
+    params = {k: v.default for k, v in inspect.signature(get_epu).parameters.items()}
+    params.update(epu_params)
+    params.update({'phase': 0, 'phase_mode': mode, 'return_girders': True})
+    if gaps is None:
+        gaps = [params['gap']]
+
+    period = params['period']
+    current_gap = params['gap']
+    current_phase = 0
+    undulator, girders, phase_girders = get_epu(**params)
+
+    Z = np.linspace(-nperiods*period/2, nperiods*period/2, npoints, endpoint=False)
+
+    first = True
+    results = {'gap': [], 'phase': [], 'bxeff': [], 'byeff': [], 'kx': [], 'ky': [], 'niter': [], 'time': []}
+    for i, gap in enumerate(gaps):
+        move_gap(girders, gap - current_gap)
+        current_gap = gap
+
+        for phase in (phases if i % 2 == 0 else phases[::-1]):
+            move_phase(phase_girders, phase - current_phase, mode)
+            current_phase = phase
+
+            t0 = time.time()
+            res = rm.relax(undulator, precision, maxiter, keep=not first)
+            dt = time.time() - t0
+            first = False
+
+            B = rf.get_field_z(undulator, Z)
+            bxeff = float(ru.get_beff(Z, B[:, 0], nperiods))
+            byeff = float(ru.get_beff(Z, B[:, 1], nperiods))
+
+            results['gap'].append(gap)
+            results['phase'].append(phase)
+            results['bxeff'].append(bxeff)
+            results['byeff'].append(byeff)
+            results['kx'].append(ru.b2k_mm(bxeff, period))
+            results['ky'].append(ru.b2k_mm(byeff, period))
+            # last entry of the relaxation result is the number of iterations
+            results['niter'].append(int(res[-1]))
+            results['time'].append(dt)
+
+            if analyze is not None:
+                for k, v in analyze(undulator, gap, phase).items():
+                    results.setdefault(k, []).append(v)
+
+            if debug: print(f'gap {gap:.3f} phase {phase:.3f} bxeff {bxeff:.4f} byeff {byeff:.4f} '
+                            f'niter {int(res[-1])} {dt:.2f} s')
+
+    return {k: np.asarray(v) for k, v in results.items()}
@@ -0,0 +1,249 @@
+import radia as rad
+import numpy as np
+
+import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.cache as rc
+import radiamodels.epu as repu
+import radiamodels.layout as rl
+import radiamodels.integrals as rint
+
+
+# m c / e for electrons in T m, gamma times the angle is the first field integral over this
+MC_OVER_E = 1.7045e-3
+
+# Block transformations from the layout of the first girder to every girder of a device as
+# (position sign, magnetization sign), position and magnetization are multiplied component-wise.
+# to and bi are x mirrors, the bottom girders are rotated by pi about z with inverted magnetization.
+EPU_GIRDERS = {
+    'ti': ([+1, +1, +1], [+1, +1, +1]),
+    'to': ([-1, +1, +1], [-1, +1, +1]),
+    'bo': ([-1, -1, +1], [+1, +1, -1]),
+    'bi': ([+1, -1, +1], [-1, +1, -1]),
+}
+PPMU_GIRDERS = {
+    'top': ([+1, +1, +1], [+1, +1, +1]),
+    'bottom': ([-1, -1, +1], [+1, +1, -1]),
+}
+
+# Girders moved by +phase and -phase in each EPU phase mode
+EPU_PHASE_MODES = repu.PHASE_MODES
+
+
+def get_device_layout (builder, **params):
+    """
+    Get the layout of all blocks of an EPU or PPMU as built by get_epu or get_ppmu with the
+    same arguments.  Taper, tilt and elevation are not modelled and must be 0.
+
+    args:
+        builder: get_epu or get_ppmu
+        params: builder arguments, defaults are those of builder
+    returns:
+        (layout, girder) with the layout of all blocks and the name of the girder of each block
+    """
+    def param (name):
+        return rc.get_param(builder, params, name)
+
+    unsupported = [k for k in ['taper', 'tilt', 'elevation'] if params.get(k, 0) != 0]
+    if unsupported:
+        raise ValueError(f'{unsupported} not supported by the device layout, they must be 0')
+
+    magnet_size_xy = param('magnet_size_xy')
+    gap = param('gap')
+    layout0 = param('layout') if 'layout' in params else None
+    if layout0 is None:
+        layout0 = rl.get_girder_layout(param('nhalfperiods'), param('period'), magnet_size_xy)
+
+    if builder.__name__ == 'get_epu':
+        girders = EPU_GIRDERS
+        # ti sits in the +x +y quadrant
+        offset = [magnet_size_xy[0]/2, magnet_size_xy[1]/2 + gap/2, 0]
+        plus, minus = EPU_PHASE_MODES[param('phase_mode').lower()]
+        phase = param('phase')
+    elif builder.__name__ == 'get_ppmu':
+        girders = PPMU_GIRDERS
+        offset = [0, magnet_size_xy[1]/2 + gap/2, 0]
+        plus, minus, phase = [], [], 0
+    else:
+        raise ValueError(f'no device layout for {builder.__name__}, only get_epu and get_ppmu')
+
+    parts = []
+    names = []
+    for name, (sign_c, sign_m) in girders.items():
+        part = layout0.copy()
+        part['center'] = (part['center'] + offset) * sign_c
+        part['mdir'] = part['mdir'] * sign_m
+        if name in plus:
+            part['center'][:, 2] += phase
+        if name in minus:
+            part['center'][:, 2] -= phase
+        parts.append(part)
+        names += [name] * len(part)
+
+    return np.concatenate(parts), np.array(names)
+
+
+def get_response (layout, Z, x=0, y=0):
+    """
+    Field of every block of a layout magnetized with a unit magnetization along x, y and z,
+    without relaxation.  The field of the device is R @ M for any block magnetizations M.
+
+    args:
+        layout: structured array with LAYOUT_DTYPE
+        Z: z positions in mm
+        x, y: transverse position in mm
+    returns:
+        R with shape (len(Z), 3, nblocks, 3): field component, block, magnetization component
+    """
+    R = np.empty((len(Z), 3, len(layout), 3))
+    for i, (center, size) in enumerate(zip(layout['center'].tolist(), layout['size'].tolist())):
+        block = rad.ObjRecMag(center, size, [1, 0, 0])
+        for j, m in enumerate(np.eye(3).tolist()):
+            rad.ObjSetM(block, m)
+            R[:, :, i, j] = rf.get_field_z(block, Z, x=x, y=y)
+        rad.UtiDel(block)
+    return R
+
+
+def _perpendicular (mdir):
+    """Two unit vectors perpendicular to each direction in mdir (n, 3)"""
+    mdir = mdir / np.linalg.norm(mdir, axis=1, keepdims=True)
+    # any axis not parallel to the direction
+    helper = np.where(np.abs(mdir[:, [2]]) < 0.9, [[0, 0, 1]], [[1, 0, 0]])
+    e1 = np.cross(mdir, helper)
+    e1 /= np.linalg.norm(e1, axis=1, keepdims=True)
+    e2 = np.cross(mdir, e1)
+    return e1, e2
+
+
+def get_poles (Z, By, fraction=0.5):
+    """Indices of the field extrema of an undulator field, |By| above fraction of its maximum"""
+    A = np.abs(By)
+    peak = (A[1:-1] >= A[:-2]) & (A[1:-1] > A[2:]) & (A[1:-1] > fraction * np.max(A))
+    return np.nonzero(peak)[0] + 1
+
+
+def get_phase_error (Z, I1x, I1y, period, K, poles):
+    """
+    RMS phase error in degrees at the poles, for fields given as first integrals along z
+
+    args:
+        Z: z positions in mm
+        I1x, I1y: first integrals from the start of Z in T m with shape (..., len(Z))
+        period: period in mm
+        K: deflection parameter
+        poles: indices into Z where the phase is taken
+    returns:
+        RMS phase error in degrees with shape (...)
+    """
+    Zm = Z / 1000
+    slip = rint.cumtrapz((I1x / MC_OVER_E)**2 + (I1y / MC_OVER_E)**2, Zm)
+    phase = 2 * np.pi / (period / 1000 * (1 + K**2 / 2)) * (Zm + slip)
+
+    # Deviation from the straight line through the phases at the poles
+    P = phase[..., poles]
+    A = np.column_stack([Zm[poles], np.ones(len(poles))])
+    coef = np.linalg.lstsq(A, P.reshape(-1, len(poles)).T, rcond=None)[0]
+    residual = P.reshape(-1, len(poles)) - (A @ coef).T
+    return np.degrees(np.sqrt(np.mean(residual**2, axis=1))).reshape(P.shape[:-1])
+
+
+def monte_carlo (
+    builder,
+    nrealizations = 1000,
+    sigma_br = 0.01,
+    sigma_angle = 0.01,
+    seed = None,
+    obj = None,
+    zmargin = 500,
+    points_per_period = 40,
+    nperiods = 2,
+    chunk_size = 1000,
+    **params,
+):
+    """
+    Random magnet errors of an EPU or PPMU from a linear response.  The field of every block with
+    a unit magnetization is computed once, then each realization of remanence and easy axis
+    errors is a matrix product.  The error field of a block is taken without relaxation, which
+    is a good approximation for NdFeB (small susceptibility) without iron.
+
+    args:
+        builder: get_epu or get_ppmu
+        nrealizations: number of random realizations
+        sigma_br: relative rms remanence error of each block
+        sigma_angle: rms easy axis angle error in rad (for each perpendicular direction)
+        seed: random seed
+        obj: solved model of the same device for the nominal field, otherwise the nominal
+             field is the sum of the block fields at remanence
+        zmargin: length in mm sampled beyond both ends of the device for the field integrals
+        points_per_period: z samples per period
+        nperiods: number of periods around z=0 for Beff
+        chunk_size: realizations per matrix product
+        params: builder arguments, taper, tilt and elevation must be 0 (see get_device_layout)
+    returns:
+        dict with z, nominal By, and per realization beff, phase_error (degrees), i1x, i1y (T mm),
+        i2x, i2y (T mm^2), each an array of nrealizations
+    """
+    period = rc.get_param(builder, params, 'period')
+    Br = rc.get_param(builder, params, 'Br')
+
+    layout, _ = get_device_layout(builder, **params)
+    zmin = np.min(layout['center'][:, 2] - layout['size'][:, 2] / 2) - zmargin
+    zmax = np.max(layout['center'][:, 2] + layout['size'][:, 2] / 2) + zmargin
+    Z = np.linspace(zmin, zmax, int((zmax - zmin) / period * points_per_period) + 1)
+
+    R = get_response(layout, Z)
+    M0 = Br * layout['mdir']
+    # as a matrix (field samples, block magnetizations) so each chunk is one matrix product
+    R = R.reshape(len(Z) * 3, len(layout) * 3)
+    B0 = rf.get_field_z(obj, Z) if obj is not None else (R @ M0.ravel()).reshape(len(Z), 3)
+
+    # Beff window of nperiods around z=0, Z itself is not aligned on the period, so
+    # linear interpolation as a matrix
+    Zw = np.linspace(-nperiods*period/2, nperiods*period/2, nperiods * points_per_period, endpoint=False)
+    W = np.zeros((len(Z), len(Zw)))
+    i = np.clip(np.searchsorted(Z, Zw) - 1, 0, len(Z) - 2)
+    t = (Zw - Z[i]) / (Z[i+1] - Z[i])
+    W[i, np.arange(len(Zw))] = 1 - t
+    W[i+1, np.arange(len(Zw))] = t
+    def window (By):
+        return By @ W
+
+    beff0 = float(ru.get_beff_bn_batch(Zw, window(B0[:, 1]), period, free_phase=True)[0])
+    K = ru.b2k_mm(beff0, period)
+    poles = get_poles(Z, B0[:, 1])
+    # leave out the ends, which are not periodic
+    poles = poles[2:-2] if len(poles) > 8 else poles
+
+    rng = np.random.default_rng(seed)
+    e1, e2 = _perpendicular(layout['mdir'])
+
+    results = {k: [] for k in ['beff', 'phase_error', 'i1x', 'i1y', 'i2x', 'i2y']}
+    for start in range(0, nrealizations, chunk_size):
+        n = min(chunk_size, nrealizations - start)
+        dbr = rng.normal(0, sigma_br, (n, len(layout), 1))
+        angle = rng.normal(0, sigma_angle, (n, len(layout), 2))
+        dM = M0 * dbr + Br * (angle[..., [0]] * e1 + angle[..., [1]] * e2)
+
+        B = B0 + (dM.reshape(n, -1) @ R.T).reshape(n, len(Z), 3)
+        Bx = B[..., 0]
+        By = B[..., 1]
+
+        # Integrals in T mm and T mm^2
+        I1x = rint.cumtrapz(Bx, Z)
+        I1y = rint.cumtrapz(By, Z)
+        results['i1x'].append(I1x[:, -1])
+        results['i1y'].append(I1y[:, -1])
+        results['i2x'].append(rint.trapz(I1x, Z))
+        results['i2y'].append(rint.trapz(I1y, Z))
+
+        results['beff'].append(ru.get_beff_bn_batch(Zw, window(By), period, free_phase=True)[0])
+        results['phase_error'].append(get_phase_error(Z, I1x / 1000, I1y / 1000, period, K, poles))
+
+    results = {k: np.concatenate(v) for k, v in results.items()}
+    results['z'] = Z
+    results['by'] = B0[:, 1]
+    results['beff_nominal'] = beff0
+    results['phase_error_nominal'] = float(get_phase_error(Z, rint.cumtrapz(B0[:, 0], Z) / 1000,
+                                                           rint.cumtrapz(B0[:, 1], Z) / 1000, period, K, poles))
+    return results
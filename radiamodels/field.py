@@ -0,0 +1,191 @@
+import radia as rad
+import radiamodels.util as ru
+import numpy as np
+
+
+# Maximum number of points handed to Radia in a single call
+CHUNK_SIZE = 10000
+
+
+def get_field (obj, points, field='b', chunk_size=CHUNK_SIZE):
+    """
+    Get the field of a radia object at many points with bulk radia calls
+
+    args:
+        obj: radia object
+        points: (N, 3) array-like of [x, y, z] points in mm
+        field: radia vector field component, eg 'b', 'h', 'a', 'm'
+        chunk_size: maximum number of points per radia call
+    returns:
+        (N, 3) float64 array of the field at each point
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+
+    B = np.empty((len(points), 3))
+    for i in range(0, len(points), chunk_size):
+        chunk = points[i:i+chunk_size]
+        # radia returns a flat [fx, fy, fz] for a single point, hence the reshape
+        B[i:i+len(chunk)] = np.asarray(rad.Fld(obj, field, chunk.tolist()), dtype=float).reshape(-1, 3)
+
+    return B
+
+
+def get_field_line (obj, start, stop, npoints, field='b', chunk_size=CHUNK_SIZE):
+    """
+    Get the field along a straight line from start to stop (inclusive)
+
+    args:
+        obj: radia object
+        start: [x, y, z] of the first point in mm
+        stop: [x, y, z] of the last point in mm
+        npoints: number of equally spaced points
+        field: radia vector field component
+        chunk_size: maximum number of points per radia call
+    returns:
+        (npoints, 3) float64 array of the field along the line
+    """
+    start = np.asarray(start, dtype=float)
+    stop = np.asarray(stop, dtype=float)
+
+    B = np.empty((npoints, 3))
+    for i in range(0, npoints, chunk_size):
+        n = min(chunk_size, npoints - i)
+        p1 = start + (stop - start) * (i / max(npoints - 1, 1))
+        p2 = start + (stop - start) * ((i + n - 1) / max(npoints - 1, 1))
+        B[i:i+n] = np.asarray(
+            rad.FldLst(obj, field, p1.tolist(), p2.tolist(), n, 'noarg'),
+            dtype=float,
+        ).reshape(-1, 3)
+
+    return B
+
+
+def get_field_z (obj, Z, x=0, y=0, field='b', chunk_size=CHUNK_SIZE):
+    """
+    Get the field at the z positions Z for a fixed transverse position
+
+    args:
+        obj: radia object
+        Z: list or array of z positions in mm
+        x: horizontal position in mm
+        y: vertical position in mm
+        field: radia vector field component
+        chunk_size: maximum number of points per radia call
+    returns:
+        (len(Z), 3) float64 array, eg B[:, 1] is By
+    """
+    Z = np.asarray(Z, dtype=float).ravel()
+    points = np.empty((len(Z), 3))
+    points[:, 0] = x
+    points[:, 1] = y
+    points[:, 2] = Z
+    return get_field(obj, points, field=field, chunk_size=chunk_size)
+
+
+def get_grid_points (X, Y, Z):
+    """
+    Get the points of a rectilinear grid
+
+    args:
+        X, Y, Z: positions along each axis (scalars are allowed, eg for a plane)
+    returns:
+        (len(X)*len(Y)*len(Z), 3) array of points with z varying fastest
+    """
+    X, Y, Z = [np.atleast_1d(np.asarray(a, dtype=float)) for a in (X, Y, Z)]
+    grid = np.meshgrid(X, Y, Z, indexing='ij')
+    return np.stack([g.ravel() for g in grid], axis=-1)
+
+
+def get_field_grid (obj, X, Y, Z, field='b', chunk_size=CHUNK_SIZE):
+    """
+    Get the field on a rectilinear grid.  A plane is a grid with a scalar on one axis.
+
+    args:
+        obj: radia object
+        X, Y, Z: positions along each axis in mm (scalars are allowed)
+        field: radia vector field component
+        chunk_size: maximum number of points per radia call
+    returns:
+        (len(X), len(Y), len(Z), 3) float64 array of the field
+    """
+    shape = [np.size(X), np.size(Y), np.size(Z), 3]
+    B = get_field(obj, get_grid_points(X, Y, Z), field=field, chunk_size=chunk_size)
+    return B.reshape(shape)
+
+
+def rolloff_map (obj, X, Y, zstart, zstop, period, nz=500, nh=7, tolerance=1e-3, chunk_size=CHUNK_SIZE):
+    """
+    Get Beff over a transverse grid from one bulk field evaluation and one batched harmonic fit
+
+    args:
+        obj: radia object (solved)
+        X: horizontal positions in mm
+        Y: vertical positions in mm
+        zstart, zstop: z window in mm, should be an integer number of periods
+        period: period in mm
+        nz: number of z points in the window
+        nh: number of odd harmonics to fit
+        tolerance: relative Beff change defining the good field region
+        chunk_size: maximum number of points per radia call
+    returns:
+        dict with x, y, beff (nx, ny), bn (nx, ny, nh) and the good field widths
+        width_x (at the y closest to 0) and width_y (at the x closest to 0)
+    """
+    X = np.atleast_1d(np.asarray(X, dtype=float))
+    Y = np.atleast_1d(np.asarray(Y, dtype=float))
+    Z = np.linspace(zstart, zstop, nz, endpoint=False)
+
+    B = get_field_grid(obj, X, Y, Z, chunk_size=chunk_size)
+    beff, bn = ru.get_beff_bn_batch(Z, B[..., 1], period, nh=nh, free_phase=True)
+
+    ix0 = int(np.argmin(np.abs(X)))
+    iy0 = int(np.argmin(np.abs(Y)))
+
+    return {
+        'x': X,
+        'y': Y,
+        'beff': beff,
+        'bn': bn,
+        'width_x': good_field_width(X, beff[:, iy0], tolerance),
+        'width_y': good_field_width(Y, beff[ix0, :], tolerance),
+    }
+
+
+def good_field_width (X, beff, tolerance, x0=0):
+    """
+    Width of the region around x0 where |beff/beff(x0) - 1| <= tolerance.  The edges are
+    linearly interpolated between samples, the region is cut at the ends of X.
+
+    args:
+        X: sorted positions
+        beff: Beff at each position
+        tolerance: relative tolerance
+        x0: center of the region
+    returns:
+        width in the units of X (0 if x0 itself is out of tolerance)
+    """
+    X = np.asarray(X, dtype=float)
+    beff = np.asarray(beff, dtype=float)
+    if len(X) < 2:
+        return 0.0
+
+    f = np.abs(beff / np.interp(x0, X, beff) - 1) - tolerance
+    i0 = int(np.argmin(np.abs(X - x0)))
+    if f[i0] > 0:
+        return 0.0
+
+    def edge (i, j):
+        # crossing of f = 0 between the good sample i and the bad sample j
+        return X[i] + (X[j] - X[i]) * f[i] / (f[i] - f[j])
+
+    left = i0
+    while left > 0 and f[left-1] <= 0:
+        left -= 1
+    xmin = X[0] if left == 0 else edge(left, left-1)
+
+    right = i0
+    while right < len(X) - 1 and f[right+1] <= 0:
+        right += 1
+    xmax = X[-1] if right == len(X) - 1 else edge(right, right+1)
+
+    return float(xmax - xmin)
@@ -0,0 +1,169 @@
+import os
+import time
+import radia as rad
+import numpy as np
+
+import radiamodels.cache as rc
+import radiamodels.sweep as rs
+import radiamodels.epu as repu
+import radiamodels.magnetization as rm
+
+
+def get_girder_forces (girders, point=None, subdivision=None):
+    """
+    Force and torque on each girder from all the other girders of a device
+
+    args:
+        girders: dict of radia objects, the girders of a builder with return_girders=True
+        point: point in mm the torques are taken about, default the center of each girder
+        subdivision: optional [kx, ky, kz] subdivision of the girder for the energy method
+    returns:
+        dict of {girder: (force in N (3,), torque in N mm (3,))}
+    """
+    k = [] if subdivision is None else [subdivision]
+
+    result = {}
+    for name, girder in girders.items():
+        others = rad.ObjCnt([g for n, g in girders.items() if n != name])
+        if point is None:
+            # center of the bounding box [xmin, xmax, ymin, ymax, zmin, zmax]
+            center = np.mean(np.reshape(rad.ObjGeoLim(girder), (3, 2)), axis=1).tolist()
+        else:
+            center = list(point)
+        force = np.ravel(rad.FldEnrFrc(girder, others, 'fxfyfz', *k))
+        torque = np.ravel(rad.FldEnrTrq(girder, others, 'txtytz', center, *k))
+        result[name] = (force, torque)
+        rad.UtiDel(others)
+    return result
+
+
+def _forces_task (device, task):
+    """
+    Forces at a run of neighbouring (gap, phase) points, moving the model of this worker in
+    place from wherever its previous task left it.  The first point relaxes from zero, the
+    others from the magnetization of the point before.
+    """
+    points, precision, maxiter, point, subdivision = task
+
+    forces = []
+    niter = []
+    for i, (gap, phase) in enumerate(points):
+        if gap != device['gap']:
+            repu.move_gap(device['girders'], gap - device['gap'])
+            device['gap'] = gap
+        if phase != device['phase']:
+            repu.move_phase(device['phase_girders'], phase - device['phase'], device['mode'])
+            device['phase'] = phase
+
+        res = rm.relax(device['undulator'], precision, maxiter, keep=i > 0)
+        # last entry of the relaxation result is the number of iterations
+        niter.append(int(res[-1]))
+
+        result = get_girder_forces(device['girders'], point, subdivision)
+        forces.append([np.concatenate(result[name]) for name in device['girders']])
+    return np.array(forces), np.array(niter)
+
+
+def get_force_map (
+    builder,
+    gaps,
+    phases = None,
+    mode = 'tibo',
+    precision = 0.0001,
+    maxiter = 10000,
+    point = None,
+    subdivision = None,
+    nworkers = None,
+    cache = True,
+    cache_dir = None,
+    debug = False,
+    **params,
+):
+    """
+    Magnetic force and torque on each girder over a gap and phase grid.  The model is built
+    once with its girders exposed (return_girders=True) and every worker process inherits it
+    (see sweep.map_model).  The grid is run in snake order (phases back and forth over the
+    gaps) and split into contiguous runs, a few per worker; each run moves the model in place
+    from point to point and relaxes from the previous point.  Results are cached by the hash
+    of the built model.
+
+    args:
+        builder: get_epu, get_ppmu or get_ivu
+        gaps: list of gaps in mm
+        phases: list of phases in mm (get_epu only)
+        mode: phase mode of get_epu, one of epu.PHASE_MODES
+        precision, maxiter: solve parameters
+        point: point in mm the torques are taken about, default the center of each girder
+        subdivision: optional [kx, ky, kz] subdivision for the energy method
+        nworkers: number of worker processes (default os.cpu_count())
+        cache: use the on-disk cache
+        cache_dir: cache directory
+        debug: print the time
+        params: builder arguments (gap, phase and return_girders are ignored)
+    returns:
+        dict with gap, phase, girder (names), force (N) and torque (N mm) with shape
+        (ngaps, nphases, ngirders, 3), and niter (ngaps, nphases)
+    """
+    gaps = np.atleast_1d(np.asarray(gaps, dtype=float))
+    if phases is None:
+        phases = [0]
+    phases = np.atleast_1d(np.asarray(phases, dtype=float))
+    if builder.__name__ != 'get_epu' and np.any(phases != 0):
+        raise ValueError(f'phases are only for get_epu, not {builder.__name__}')
+
+    params = dict(params, return_girders=True)
+    if builder.__name__ == 'get_epu':
+        params.update({'phase': 0, 'phase_mode': mode})
+    built = builder(**params)
+    undulator, girders = built[:2]
+    device = {
+        'undulator': undulator,
+        'girders': girders,
+        # get_epu also returns the girders moved by the phase
+        'phase_girders': built[2] if len(built) > 2 else {},
+        'gap': rc.get_param(builder, params, 'gap'),
+        'phase': 0,
+        'mode': mode,
+    }
+
+    if cache:
+        key = rc.param_hash(get_force_map, {
+            'model': rc.model_hash(undulator), 'gaps': gaps, 'phases': phases, 'mode': mode,
+            'point': point, 'subdivision': subdivision,
+        }, precision, maxiter)
+        result = rc.load(key, cache_dir)
+        if result is not None:
+            return result
+
+    t0 = time.time()
+    # Snake order so consecutive points are neighbours, in contiguous runs of a few per worker
+    indices = []
+    for i in range(len(gaps)):
+        order = range(len(phases)) if i % 2 == 0 else range(len(phases))[::-1]
+        indices += [(i, j) for j in order]
+    if nworkers is None:
+        nworkers = os.cpu_count()
+    size = max(1, -(-len(indices) // (rs.WARM_START_CHUNKS * max(1, nworkers))))
+    runs = [indices[k:k+size] for k in range(0, len(indices), size)]
+    tasks = [([(gaps[i], phases[j]) for i, j in run], precision, maxiter, point, subdivision) for run in runs]
+    results = rs.map_model(_forces_task, device, tasks, nworkers)
+    if debug: print(f'{len(gaps)} x {len(phases)} points in {len(tasks)} tasks in {time.time() - t0:.2f} s')
+
+    F = np.zeros((len(gaps), len(phases), len(girders), 6))
+    niter = np.zeros((len(gaps), len(phases)), dtype=int)
+    for run, (forces, n) in zip(runs, results):
+        for (i, j), f, k in zip(run, forces, n):
+            F[i, j] = f
+            niter[i, j] = k
+
+    result = {
+        'gap': gaps,
+        'phase': phases,
+        'girder': np.array(list(girders)),
+        'force': F[..., :3],
+        'torque': F[..., 3:],
+        'niter': niter,
+    }
+    if cache:
+        rc.save(key, result, cache_dir)
+    return result
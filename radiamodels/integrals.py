@@ -0,0 +1,97 @@
+import radia as rad
+import numpy as np
+
+import radiamodels.field as rf
+import radiamodels.cache as rc
+import radiamodels.sweep as rs
+
+
+def cumtrapz (F, Z):
+    """
+    Cumulative trapezoid integral of F along its last axis, starting at 0
+
+    args:
+        F: array with shape (..., N)
+        Z: positions (N,)
+    returns:
+        array with the same shape as F
+    """
+    dZ = np.diff(Z)
+    I = np.zeros_like(F, dtype=float)
+    I[..., 1:] = np.cumsum(0.5 * (F[..., 1:] + F[..., :-1]) * dZ, axis=-1)
+    return I
+
+
+def trapz (F, Z):
+    """Trapezoid integral of F along its last axis"""
+    return np.sum(0.5 * (F[..., 1:] + F[..., :-1]) * np.diff(Z), axis=-1)
+
+
+def _integrals_task (obj, task):
+    """First and second field integrals for a list of (x, y) points"""
+    XY, zmin, zmax, nz = task
+    Z = np.linspace(zmin, zmax, nz)
+
+    points = np.empty((len(XY), nz, 3))
+    points[..., 0] = XY[:, 0, None]
+    points[..., 1] = XY[:, 1, None]
+    points[..., 2] = Z
+    B = rf.get_field(obj, points.reshape(-1, 3)).reshape(len(XY), nz, 3)
+
+    # first integral over the infinite line, second integral from the samples
+    I1 = np.array([rad.FldInt(obj, 'inf', 'ibxiby', [x, y, zmin], [x, y, zmax]) for x, y in XY])
+    I2 = trapz(cumtrapz(B[..., :2].transpose(0, 2, 1), Z), Z)
+
+    return np.hstack([I1, I2])
+
+
+def get_field_integrals (obj, X, Y=0, zmin=-1000, zmax=1000, nz=4001, nworkers=None, cache=True, cache_dir=None):
+    """
+    Get the first and second field integrals along z over a transverse grid.
+
+    The first integrals use rad.FldInt over the infinite line, the second integrals
+    I2(zmax) = int_zmin^zmax int_zmin^z B dz' dz use nz field samples, so [zmin, zmax] must
+    contain the whole field.  Grid points are distributed over forked worker processes
+    which inherit the solved model (see sweep.map_model), and results are cached by the
+    hash of the model state.
+
+    args:
+        obj: radia object (solved)
+        X: horizontal positions in mm
+        Y: vertical positions in mm
+        zmin, zmax: z range in mm for the second integrals
+        nz: number of z samples
+        nworkers: number of worker processes (default os.cpu_count())
+        cache: use the on-disk cache
+        cache_dir: cache directory
+    returns:
+        dict with x, y and i1x, i1y (T mm), i2x, i2y (T mm^2) with shape (nx, ny)
+    """
+    X = np.atleast_1d(np.asarray(X, dtype=float))
+    Y = np.atleast_1d(np.asarray(Y, dtype=float))
+
+    if cache:
+        key = rc.param_hash(get_field_integrals, {
+            'model': rc.model_hash(obj), 'x': X, 'y': Y, 'zmin': zmin, 'zmax': zmax, 'nz': nz,
+        })
+        result = rc.load(key, cache_dir)
+        if result is not None:
+            return result
+
+    XY = rf.get_grid_points(X, Y, 0)[:, :2]
+
+    # One task per x position, each a bulk field evaluation over all y
+    tasks = [(xy, zmin, zmax, nz) for xy in np.split(XY, len(X))]
+    I = np.vstack(rs.map_model(_integrals_task, obj, tasks, nworkers)).reshape(len(X), len(Y), 4)
+
+    result = {
+        'x': X,
+        'y': Y,
+        'i1x': I[..., 0],
+        'i1y': I[..., 1],
+        'i2x': I[..., 2],
+        'i2y': I[..., 3],
+    }
+    if cache:
+        rc.save(key, result, cache_dir)
+    return result
@@ -1,8 +1,11 @@
+import time
+import inspect
 import radia as rad
 import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.magnetization as rm
 import numpy as np
 
-from radiamodels.common import *
 
 def get_quartermagnet (
     size,
@@ -132,7 +135,7 @@ def get_ivu (
     nhalfperiods = 2,
     
     half_pole_size = [38/2, 21.5, 2.8],
-    pole_material = ru.get_magnetic_material_permendur(),
+    pole_material = None,
     pole_body_divisions = [3, 3, 3],
     pole_tip_divisions = [5, [5, 6], 5],
     pole_chamfer_shortedge = 2,
@@ -141,7 +144,7 @@ def get_ivu (
     pole_offset_y = 0,
     
     quartermagnet_size_xy = [58/2, 30],
-    magnet_material = rad.MatLin([0.05, 0.15], [0, 0, 1.30]),
+    magnet_material = None,
     magnet_divisions = [3, 3, 3],
     magnet_chamfer_corner = 1,
     magnet_chamfer_outerside = 0,
@@ -159,11 +162,36 @@ def get_ivu (
     girder_top_roll_rad = 0,
     girder_bot_roll_rad = 0,
     returnobject = 0,
+    symmetry = True,
+    periodic = False,
+    return_girders = False,
 
     debug = False,
 ):
     # build the IVU
 
+    # Mirror symmetries which survive the misalignments are kept as radia symmetries so only the
+    # irreducible part of the device is relaxed.  x (inner/outer) is broken by girder roll,
+    # y (top/bottom) by rolls which are not opposite, z (upstream/downstream) by the taper.
+    # Tilt is a rotation of the whole device and breaks nothing.  symmetry=False builds everything.
+    # With periodic=True the periodic body is one module repeated by rad.TrfMlt, so the object
+    # tree does not grow with the length, but all its modules then share one magnetization
+    # (alternating) in the relaxation, which changes the ends.  Only use it where
+    # examples/ivu_periodic_check.py shows the difference is acceptable.  periodic=False
+    # (default) duplicates every module.
+    # return_girders=True builds the top and bottom girders explicitly and also returns them
+    # as {'top': ..., 'bottom': ...}, each placed by roll, taper and gap (before tilt).
+    symmetric_x = symmetry and girder_top_roll_rad == 0 and girder_bot_roll_rad == 0
+    symmetric_y = symmetry and not return_girders and girder_top_roll_rad == -girder_bot_roll_rad
+    symmetric_z = symmetry and taper == 0
+    if debug: print('symmetric x y z', symmetric_x, symmetric_y, symmetric_z)
+
+    # Default materials are created here rather than as default arguments so nothing is created at import
+    if pole_material is None:
+        pole_material = ru.get_magnetic_material_permendur()
+    if magnet_material is None:
+        magnet_material = ru.get_material_linear([0.05, 0.15], [0, 0, 1.30])
+
     length = period * nhalfperiods/2
     
     # air_gap is taken out of the magnet
@@ -208,14 +236,23 @@ def get_ivu (
    
     # Top outer downstream section
     girder_tod = rad.ObjCnt([])
-    for i in range(nhalfperiods//2):
-        z_piece = z_first_module + i * period/2
+    if periodic and nhalfperiods//2 > 1:
+        # First piece, then each next one is a half period further with alternating field
         piece = rad.ObjDpl(module)
-        rad.TrfOrnt(piece, rad.TrfTrsl([0, 0, z_piece]))
-        # Adjust for alternating field
-        if i % 2 == 0:
-            rad.TrfOrnt(piece, rad.TrfInv()) 
+        rad.TrfOrnt(piece, rad.TrfTrsl([0, 0, z_first_module]))
+        rad.TrfOrnt(piece, rad.TrfInv())
+        trfHalfPeriod = rad.TrfCmbR(rad.TrfTrsl([0, 0, period/2]), rad.TrfInv())
+        piece = rad.TrfMlt(piece, trfHalfPeriod, nhalfperiods//2)
         rad.ObjAddToCnt(girder_tod, [piece])
+    else:
+        for i in range(nhalfperiods//2):
+            z_piece = z_first_module + i * period/2
+            piece = rad.ObjDpl(module)
+            rad.TrfOrnt(piece, rad.TrfTrsl([0, 0, z_piece]))
+            # Adjust for alternating field
+            if i % 2 == 0:
+                rad.TrfOrnt(piece, rad.TrfInv()) 
+            rad.ObjAddToCnt(girder_tod, [piece])
 
     if returnobject == 2:
         return girder_tod
@@ -293,30 +330,43 @@ def get_ivu (
     if returnobject == 4:
         return girder_tod  
 
-    # clone for top outer upsteam portion
-    girder_tou = rad.ObjDpl(girder_tod)
-    rad.TrfOrnt(girder_tou, rad.TrfPlSym([0, 0, 0], [0, 0, 1]))
-    if nhalfperiods % 2 == 0:
-        rad.TrfOrnt(girder_tou, rad.TrfInv())
-    girder_to = rad.ObjCnt([girder_tod, girder_tou])
+    # top outer upstream portion, the mirror of downstream
+    if symmetric_z:
+        if nhalfperiods % 2 == 0:
+            rad.TrfZerPara(girder_tod, [0, 0, 0], [0, 0, 1])
+        else:
+            rad.TrfZerPerp(girder_tod, [0, 0, 0], [0, 0, 1])
+        girder_to = rad.ObjCnt([girder_tod])
+    else:
+        # clone for top outer upsteam portion
+        girder_tou = rad.ObjDpl(girder_tod)
+        rad.TrfOrnt(girder_tou, rad.TrfPlSym([0, 0, 0], [0, 0, 1]))
+        if nhalfperiods % 2 == 0:
+            rad.TrfOrnt(girder_tou, rad.TrfInv())
+        girder_to = rad.ObjCnt([girder_tod, girder_tou])
     if nhalfperiods % 2:
         rad.ObjAddToCnt(girder_to, [module])
 
     if returnobject == 5:
         return girder_to
 
-    # clone and reflect for top inner
-    girder_ti = rad.ObjDpl(girder_to)
-    rad.TrfOrnt(girder_ti, rad.TrfPlSym([0, 0, 0], [1, 0, 0]))
-
-    # Top girder
-    girder_top = rad.ObjCnt([girder_to, girder_ti])
+    # top inner, the mirror of top outer
+    if symmetric_x:
+        rad.TrfZerPerp(girder_to, [0, 0, 0], [1, 0, 0])
+        girder_top = rad.ObjCnt([girder_to])
+    else:
+        # clone and reflect for top inner
+        girder_ti = rad.ObjDpl(girder_to)
+        rad.TrfOrnt(girder_ti, rad.TrfPlSym([0, 0, 0], [1, 0, 0]))
+
+        # Top girder
+        girder_top = rad.ObjCnt([girder_to, girder_ti])
     if returnobject == 6:
         return girder_top
 
 
     # Best is if this is symmetric
-    if girder_top_roll_rad == -girder_bot_roll_rad and tilt == 0:
+    if symmetric_y:
         if debug: print('fast symmetric')
 
         # Roll for top and bottom girder
@@ -332,7 +382,14 @@ def get_ivu (
         # Do the gap shift and mirror symmetry
         rad.TrfOrnt(girder_top, rad.TrfTrsl([0, +gap/2, 0]))
         rad.TrfZerPara(girder_top, [0,0,0], [0,1,0])
-        return girder_top
+
+        # Construct undulator, outside of the symmetry so the tilt moves the whole device
+        undulator = rad.ObjCnt([girder_top])
+        if tilt != 0:
+            tilt_mm_per_mm = tilt / length
+            phi_tilt = np.arcsin(tilt_mm_per_mm)
+            rad.TrfOrnt(undulator, rad.TrfRot([0, 0, 0], [1, 0, 0], phi_tilt))
+        return undulator
 
 
     # CAREFUL: below here will take longer
@@ -374,4 +431,231 @@ def get_ivu (
         phi_tilt = np.arcsin(tilt_mm_per_mm)
         rad.TrfOrnt(undulator, rad.TrfRot([0, 0, 0], [1, 0, 0], phi_tilt))
 
+    if return_girders:
+        return undulator, {'top': girder_top, 'bottom': girder_bot}
+
     return undulator
+
+
+
+def scan_gap (
+    gaps,
+    precision = 0.0001,
+    maxiter = 10000,
+    nperiods = 2,
+    npoints = 500,
+    analyze = None,
+    debug = False,
+    **ivu_params,
+):
+    """
+    Solve get_ivu(**ivu_params) at each gap in gaps.  The top girder is built only once and
+    moved between gaps, and each relaxation starts from the magnetization of the previous gap
+    (magnetization.relax, rad.Solve would start from zero), so gaps should be given in a
+    monotonic order.
+
+    Only the symmetric case is supported (girder_bot_roll_rad == -girder_top_roll_rad).
+
+    args:
+        gaps: list of gaps in mm
+        precision: solve precision
+        maxiter: maximum solve iterations per gap
+        nperiods: number of periods around z=0 used for Beff
+        npoints: number of z points used for Beff
+        analyze: optional function analyze(undulator, gap) returning a dict of extra results per gap
+        ivu_params: passed to get_ivu (gap and returnobject are ignored)
+    returns:
+        dict of arrays: gap, beff, keff, bmax, niter, time and anything returned by analyze
+    """
+    params = {k: v.default for k, v in inspect.signature(get_ivu).parameters.items()}
+    params.update(ivu_params)
+    params['returnobject'] = 6
+
+    if params['girder_top_roll_rad'] != -params['girder_bot_roll_rad'] or not params['symmetry']:
+        raise ValueError('scan_gap needs girder_bot_roll_rad == -girder_top_roll_rad and symmetry')
+
+    period = params['period']
+    length = period * params['nhalfperiods']/2
+
+    # Girder built once at gap=0, then same orientation as the symmetric get_ivu
+    girder_top = get_ivu(**params)
+    if params['girder_top_roll_rad'] != 0:
+        rad.TrfOrnt(girder_top, rad.TrfRot([0, 0, 0], [0, 0, 1], params['girder_top_roll_rad']))
+    if params['taper'] != 0:
+        phi_taper = np.arcsin(params['taper'] / length / 2)
+        rad.TrfOrnt(girder_top, rad.TrfRot([0, 0, 0], [-1, 0, 0], phi_taper))
+
+    # The symmetry lives on the outer container so the girder can be moved inside it
+    current_gap = 0
+    girders = rad.ObjCnt([girder_top])
+    rad.TrfZerPara(girders, [0, 0, 0], [0, 1, 0])
+
+    # and the tilt on one more level so it moves the whole device
+    undulator = rad.ObjCnt([girders])
+    if params['tilt'] != 0:
+        phi_tilt = np.arcsin(params['tilt'] / length)
+        rad.TrfOrnt(undulator, rad.TrfRot([0, 0, 0], [1, 0, 0], phi_tilt))
+
+    Z = np.linspace(-nperiods*period/2, nperiods*period/2, npoints, endpoint=False)
+
+    results = {'gap': [], 'beff': [], 'keff': [], 'bmax': [], 'niter': [], 'time': []}
+    for gap in gaps:
+        rad.TrfOrnt(girder_top, rad.TrfTrsl([0, (gap - current_gap)/2, 0]))
+        current_gap = gap
+
+        t0 = time.time()
+        res = rm.relax(undulator, precision, maxiter, keep=len(results['gap']) > 0)
+        dt = time.time() - t0
+
+        B = rf.get_field_z(undulator, Z)
+        beff = float(ru.get_beff(Z, B[:, 1], nperiods))
+
+        results['gap'].append(gap)
+        results['beff'].append(beff)
+        results['keff'].append(ru.b2k_mm(beff, period))
+        results['bmax'].append(float(np.max(np.abs(B[:, 1]))))
+        # last entry of the solve result is the number of iterations
+        results['niter'].append(int(res[-1]))
+        results['time'].append(dt)
+
+        if analyze is not None:
+            for k, v in analyze(undulator, gap).items():
+                results.setdefault(k, []).append(v)
+
+        if debug: print(f'gap {gap:.3f} beff {beff:.4f} niter {int(res[-1])} {dt:.2f} s')
+
+    return {k: np.asarray(v) for k, v in results.items()}
+
+
+
+def _place_girder (girder, roll, phi_taper, gap, bottom=False):
+    """Container placing a girder built at gap 0 as the top or bottom girder of get_ivu"""
+    placed = rad.ObjCnt([girder])
+    if bottom:
+        rad.TrfOrnt(placed, rad.TrfPlSym([0, 0, 0], [0, 1, 0]))
+        rad.TrfOrnt(placed, rad.TrfInv())
+    if roll != 0:
+        rad.TrfOrnt(placed, rad.TrfRot([0, 0, 0], [0, 0, 1], roll))
+    if phi_taper != 0:
+        rad.TrfOrnt(placed, rad.TrfRot([0, 0, 0], [+1 if bottom else -1, 0, 0], phi_taper))
+    rad.TrfOrnt(placed, rad.TrfTrsl([0, -gap/2 if bottom else +gap/2, 0]))
+    return placed
+
+
+def scan_misalignment (
+    misalignments,
+    precision = 0.0001,
+    maxiter = 10000,
+    relax_iterations = 0,
+    nperiods = 2,
+    npoints = 500,
+    Z = None,
+    debug = False,
+    **ivu_params,
+):
+    """
+    Field change of small rigid girder misalignments with frozen magnetization.  The nominal
+    device (no roll, taper or tilt) is solved once with its top/bottom symmetry, then an
+    explicit top and bottom girder with the solved magnetization are rolled, tapered and
+    tilted as in get_ivu and only the field is evaluated.  With relax_iterations > 0 each
+    misalignment is followed by that many relaxation iterations from the nominal state, the
+    x and z symmetries inside each girder are kept in that relaxation.
+
+    args:
+        misalignments: list of dicts with any of girder_top_roll_rad, girder_bot_roll_rad,
+                       taper and tilt (0 if not given)
+        precision: solve precision
+        maxiter: maximum iterations of the nominal solve
+        relax_iterations: relaxation iterations after each misalignment, 0 for frozen magnetization
+        nperiods, npoints: z points around z=0 if Z is not given, and the Beff region
+        Z: z positions in mm for the field
+        debug: print progress
+        ivu_params: passed to get_ivu, misalignments in it are ignored
+    returns:
+        dict with z, b_nominal (len(Z), 3), beff_nominal, and arrays over the misalignments of
+        db (field change (len(Z), 3)), beff, niter (relaxation iterations) and time
+    """
+    params = {k: v.default for k, v in inspect.signature(get_ivu).parameters.items()}
+    params.update(ivu_params)
+    params.update({'girder_top_roll_rad': 0, 'girder_bot_roll_rad': 0, 'taper': 0, 'tilt': 0, 'returnobject': 6})
+
+    period = params['period']
+    gap = params['gap']
+    length = period * params['nhalfperiods']/2
+    if Z is None:
+        Z = np.linspace(-nperiods*period/2, nperiods*period/2, npoints, endpoint=False)
+
+    # Nominal device solved with the top/bottom symmetry
+    t0 = time.time()
+    girder_top = get_ivu(**params)
+    nominal = _place_girder(girder_top, 0, 0, gap)
+    girders = rad.ObjCnt([nominal])
+    rad.TrfZerPara(girders, [0, 0, 0], [0, 1, 0])
+    rad.Solve(girders, precision, maxiter)
+    M = rm.get_magnetization(girder_top)
+    rad.UtiDel(girders)
+    rad.UtiDel(nominal)
+
+    # The same girder built again for the bottom, with the magnetization of the top
+    girder_bot = get_ivu(**params)
+    rm.set_magnetization(girder_bot, M)
+    if debug: print(f'nominal solved in {time.time() - t0:.2f} s')
+
+    def place (roll_top=0, roll_bot=0, taper=0, tilt=0):
+        """Device and the containers created for it, to delete them after use"""
+        phi_taper = np.arcsin(taper / length / 2)
+        placed = [
+            _place_girder(girder_top, roll_top, phi_taper, gap),
+            _place_girder(girder_bot, roll_bot, phi_taper, gap, bottom=True),
+        ]
+        device = rad.ObjCnt(placed)
+        if tilt != 0:
+            rad.TrfOrnt(device, rad.TrfRot([0, 0, 0], [1, 0, 0], np.arcsin(tilt / length)))
+        return device, [device] + placed
+
+    def delete (objs):
+        # only the containers, the girders are shared by every step
+        for obj in objs:
+            rad.UtiDel(obj)
+
+    device, created = place()
+    B0 = rf.get_field_z(device, Z)
+    delete(created)
+    beff0 = float(ru.get_beff(Z, B0[:, 1], nperiods))
+
+    results = {'db': [], 'beff': [], 'niter': [], 'time': []}
+
+    for misalignment in misalignments:
+        t0 = time.time()
+        device, created = place(
+            misalignment.get('girder_top_roll_rad', 0),
+            misalignment.get('girder_bot_roll_rad', 0),
+            misalignment.get('taper', 0),
+            misalignment.get('tilt', 0),
+        )
+
+        niter = 0
+        if relax_iterations > 0:
+            # from the nominal magnetization set on the girders, not from zero as rad.Solve
+            res = rm.relax(device, precision, relax_iterations)
+            # last entry of the relaxation result is the number of iterations
+            niter = int(res[-1])
+
+        B = rf.get_field_z(device, Z)
+        dt = time.time() - t0
+        delete(created)
+
+        if relax_iterations > 0:
+            # back to the nominal state for the next misalignment
+            rm.set_magnetization(girder_top, M)
+            rm.set_magnetization(girder_bot, M)
+
+        results['db'].append(B - B0)
+        results['beff'].append(float(ru.get_beff(Z, B[:, 1], nperiods)))
+        results['niter'].append(niter)
+        results['time'].append(dt)
+        if debug: print(misalignment, f"dbeff {results['beff'][-1] - beff0:.3e} {dt:.3f} s")
+
+    results = {k: np.asarray(v) for k, v in results.items()}
+    results.update({'z': Z, 'b_nominal': B0, 'beff_nominal': beff0})
+    return results
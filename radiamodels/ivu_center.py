@@ -1,11 +1,15 @@
 import time
 import numpy as np
-import matplotlib.pyplot as plt
 
 import radia as rad
 import radiamodels.util as ru
+import radiamodels.field as rf
 
 
+# Solve settings of get_solve_beff
+SOLVE_PRECISION = 0.0001
+SOLVE_MAXITER = 10000
+
 default_params = {
     'gap': 5.0,
     'period': 20.0,
@@ -50,7 +54,7 @@ def get_ivu_center (
     pole_material = ru.get_magnetic_material_permendur()
 
     magnet_size = magnet_size[:] + [period/2 - pole_size[2] - 2*airgap]
-    mag_material = rad.MatStd('NdFeB', br)
+    mag_material = ru.get_material_std('NdFeB', br)
     if debug:
         print(f'magnet_size={magnet_size}')
 
@@ -149,20 +153,21 @@ def get_solve_beff (**params):
     und = get_ivu_center(**params)
 
     t0 = time.time()
-    rad.Solve(und, 0.0001, 10000)
+    rad.Solve(und, SOLVE_PRECISION, SOLVE_MAXITER)
     if debug:
         print(f'{time.time() - t0:.2f} s')
 
     Z = np.linspace(-period/2, period/2, 501)
-    B = [rad.Fld(und, 'b', [0, 0, z]) for z in Z]
+    B = rf.get_field_z(und, Z)
     
     if debug:
+        import matplotlib.pyplot as plt
         plt.figure()
         for i in range(3):
-            plt.plot(Z, [b[i] for b in B])
+            plt.plot(Z, B[:, i])
         plt.show()
 
-    bmax = max([abs(b[1]) for b in B])
+    bmax = float(np.max(np.abs(B[:, 1])))
     kmax = ru.b2k_mm(bmax, period)
 
     beff, bn = ru.get_beff_bn(Z, B, period=period)
@@ -0,0 +1,113 @@
+import numpy as np
+
+import radiamodels.field as rf
+import radiamodels.sweep as rs
+import radiamodels.integrals as rint
+
+
+def _kickmap_task (obj, task):
+    """Kick potential and first integrals along z for a list of (x, y) points"""
+    XY, zmin, zmax, nz = task
+    Z = np.linspace(zmin, zmax, nz)
+
+    points = np.empty((len(XY), nz, 3))
+    points[..., 0] = XY[:, 0, None]
+    points[..., 1] = XY[:, 1, None]
+    points[..., 2] = Z
+    B = rf.get_field(obj, points.reshape(-1, 3)).reshape(len(XY), nz, 3)
+
+    # in SI: I(z) = int_zmin^z B dz' in T m, phi = int (Ix^2 + Iy^2) dz in T^2 m^3
+    Zm = Z / 1000
+    I = rint.cumtrapz(B[..., :2].transpose(0, 2, 1), Zm)
+    phi = rint.trapz(I[:, 0]**2 + I[:, 1]**2, Zm)
+
+    return np.stack([phi, I[:, 0, -1], I[:, 1, -1]], axis=-1)
+
+
+def _gradient (F, X, axis):
+    if len(X) < 2:
+        return np.zeros_like(F)
+    return np.gradient(F, X, axis=axis)
+
+
+def get_kickmap (obj, X, Y, zmin, zmax, nz=4001, length=None, nworkers=None):
+    """
+    Get the kick map of a solved model on a transverse grid (P. Elleaume, EPAC 1992).
+
+    The second order kicks are -1/2 dPhi/dx and -1/2 dPhi/dy with
+    Phi(x, y) = int [(int_zmin^z Bx dz')^2 + (int_zmin^z By dz')^2] dz, in T^2 m^2 so that
+    the angles are the kicks divided by (B rho)^2.  [zmin, zmax] must contain the whole field.
+    Each x position is one task for sweep.map_model, evaluated with one bulk field call.
+
+    args:
+        obj: radia object (solved)
+        X: horizontal positions in mm (sorted)
+        Y: vertical positions in mm (sorted)
+        zmin, zmax: z range in mm
+        nz: number of z samples
+        length: device length in m written to the file (default (zmax - zmin) / 1000)
+        nworkers: number of worker processes (default os.cpu_count())
+    returns:
+        dict with x, y (mm), length (m), kickx, kicky (T^2 m^2) and i1x, i1y (T m)
+        with shape (nx, ny)
+    """
+    X = np.atleast_1d(np.asarray(X, dtype=float))
+    Y = np.atleast_1d(np.asarray(Y, dtype=float))
+    XY = rf.get_grid_points(X, Y, 0)[:, :2]
+
+    tasks = [(xy, zmin, zmax, nz) for xy in np.split(XY, len(X))]
+    K = np.vstack(rs.map_model(_kickmap_task, obj, tasks, nworkers)).reshape(len(X), len(Y), 3)
+
+    phi = K[..., 0]
+    return {
+        'x': X,
+        'y': Y,
+        'length': (zmax - zmin) / 1000 if length is None else length,
+        'kickx': -0.5 * _gradient(phi, X / 1000, axis=0),
+        'kicky': -0.5 * _gradient(phi, Y / 1000, axis=1),
+        'i1x': K[..., 1],
+        'i1y': K[..., 2],
+    }
+
+
+def write_kickmap (kickmap, fn, comment=None, first_order=True):
+    """
+    Write a kick map in the text format read by elegant, Tracy, SPECTRA and others.
+    Positions are in m, each block has a header row of x and one row per y from top to bottom.
+
+    args:
+        kickmap: dict from get_kickmap
+        fn: filename
+        comment: optional comment line(s) written at the top
+        first_order: also write the first order kicks (field integrals in T m)
+
+    returns nothing
+    """
+    X = np.asarray(kickmap['x']) / 1000
+    Y = np.asarray(kickmap['y']) / 1000
+
+    blocks = [
+        ('Horizontal 2nd Order Kick [T2m2]', kickmap['kickx']),
+        ('Vertical 2nd Order Kick [T2m2]', kickmap['kicky']),
+    ]
+    if first_order:
+        # signs for electrons travelling along +z: a positive By kicks towards +x
+        blocks += [
+            ('Horizontal 1st Order Kick [T m]', np.asarray(kickmap['i1y'])),
+            ('Vertical 1st Order Kick [T m]', -np.asarray(kickmap['i1x'])),
+        ]
+
+    with open(fn, 'w') as fo:
+        if comment is not None:
+            for line in str(comment).splitlines():
+                fo.write(f'# {line}\n')
+        fo.write(f'# Undulator Length [m]\n{kickmap["length"]:.6g}\n')
+        fo.write(f'# Number of Horizontal Points\n{len(X)}\n')
+        fo.write(f'# Number of Vertical Points\n{len(Y)}\n')
+
+        for title, K in blocks:
+            fo.write(f'# {title}\nSTART\n')
+            fo.write(' ' * 14 + ' '.join(f'{x:+.6e}' for x in X) + '\n')
+            for j in range(len(Y) - 1, -1, -1):
+                fo.write(f'{Y[j]:+.6e} ' + ' '.join(f'{k:+.6e}' for k in K[:, j]) + '\n')
+    return
@@ -0,0 +1,117 @@
+import radia as rad
+import numpy as np
+import hashlib
+
+
+# One row per block: center and size in mm, initial magnetization direction (the easy axis),
+# material key looked up in the materials dict given to build_layout, and drawing color
+LAYOUT_DTYPE = np.dtype([
+    ('center', 'f8', 3),
+    ('size', 'f8', 3),
+    ('mdir', 'f8', 3),
+    ('material', 'U32'),
+    ('color', 'f8', 3),
+])
+
+# Halbach sequence of magnetization directions along z
+MAGNET_STRENGTHS = np.array([
+    [0,  0, +1],
+    [0, -1,  0],
+    [0,  0, -1],
+    [0, +1,  0],
+], dtype=float)
+
+
+def get_girder_layout (nhalfperiods, period, magnet_size_xy, material='NdFeB', colors=[[0, 0, 1]]):
+    """
+    Get the layout of one girder of a pure permanent magnet (Halbach) undulator centered on z=0,
+    with a half length vertical first and last magnet and end pieces of 3 * period / 20 and
+    period / 8 on both ends, as used by get_epu and get_ppmu.
+
+    args:
+        nhalfperiods: number of half periods
+        period: period in mm
+        magnet_size_xy: [x, y] size of the magnets in mm
+        material: material key of all blocks
+        colors: list of colors cycled along the girder
+    returns:
+        layout, structured array with LAYOUT_DTYPE
+    """
+    end_outer_length = 3 * period / 20
+    end_inner_length = period / 8
+    # total length including terminations
+    length = nhalfperiods * period / 2 + 2 * end_outer_length
+    nhalfperiods = int(2 * length / period)
+
+    mz = period / 4
+    nmagnets = nhalfperiods * 2 + 1
+    i = np.arange(-2, nmagnets)
+
+    z = -length / 2 + end_outer_length + end_inner_length + i * mz + mz / 2
+    sz = np.full(len(i), mz)
+
+    # End pieces, in reverse order so the first matching case wins as in the original loops
+    ends = [
+        (nmagnets - 1, length / 2 - end_outer_length / 2, end_outer_length),
+        (nmagnets - 2, length / 2 - end_outer_length - end_inner_length / 2, end_inner_length),
+        (-1, -length / 2 + end_outer_length + end_inner_length / 2, mz / 2),
+        (-2, -length / 2 + end_outer_length / 2, end_outer_length),
+    ]
+    for index, center, size in ends:
+        z[i == index] = center
+        sz[i == index] = size
+
+    layout = np.zeros(len(i), dtype=LAYOUT_DTYPE)
+    layout['center'][:, 2] = z
+    layout['size'][:, 0] = magnet_size_xy[0]
+    layout['size'][:, 1] = magnet_size_xy[1]
+    layout['size'][:, 2] = sz
+    layout['mdir'] = MAGNET_STRENGTHS[i % 4]
+    layout['material'] = material
+    layout['color'] = np.asarray(colors, dtype=float)[i % len(colors)]
+    return layout
+
+
+def build_layout (layout, materials, divisions, container=None):
+    """
+    Build the blocks of a layout
+
+    args:
+        layout: structured array with LAYOUT_DTYPE
+        materials: dict of {material key: radia material}
+        divisions: subdivision of every block, as for rad.ObjFullMag
+        container: radia container to add the blocks to, a new one if None
+    returns:
+        radia container
+    """
+    if container is None:
+        container = rad.ObjCnt([])
+
+    # Plain lists once, radia is called with python floats for every block anyway
+    centers = layout['center'].tolist()
+    sizes = layout['size'].tolist()
+    mdirs = layout['mdir'].tolist()
+    colors = layout['color'].tolist()
+    mats = [materials[m] for m in layout['material']]
+
+    for center, size, mdir, mat, color in zip(centers, sizes, mdirs, mats, colors):
+        rad.ObjFullMag(center, size, mdir, divisions, container, mat, color)
+
+    return container
+
+
+def layout_hash (layout):
+    """Hash of a layout, equal for layouts with exactly the same blocks"""
+    layout = np.ascontiguousarray(layout, dtype=LAYOUT_DTYPE)
+    return hashlib.sha256(layout.tobytes()).hexdigest()
+
+
+def save_layout (layout, fn):
+    """Save a layout to a .npy file"""
+    np.save(fn, np.asarray(layout, dtype=LAYOUT_DTYPE))
+    return
+
+
+def load_layout (fn):
+    """Load a layout saved by save_layout"""
+    return np.load(fn).astype(LAYOUT_DTYPE, copy=False)
@@ -0,0 +1,268 @@
+import time
+import inspect
+import radia as rad
+import numpy as np
+
+
+# Element centers and magnetization of the last model solved with warm start in this process
+_last = None
+
+# Largest element displacement relative to the model extent accepted by warm_start
+WARM_START_TOLERANCE = 0.1
+
+
+def _children (obj):
+    try:
+        return rad.ObjCntStuf(obj)
+    except Exception:
+        # radia raises for objects which are not containers
+        return None
+
+
+def get_elements (obj):
+    """
+    Get the elements of a radia object, the leaves of its container tree in depth-first order.
+    Two models built by the same builder have their elements in the same order.
+
+    returns:
+        list of radia element IDs
+    """
+    children = _children(obj)
+    if children is None:
+        return [obj]
+
+    elements = []
+    for child in children:
+        elements += get_elements(child)
+
+    # An object can be in more than one container
+    return list(dict.fromkeys(elements))
+
+
+def delete_model (obj):
+    """
+    Delete a radia object and every object of its container tree, eg a model which is no longer
+    needed after its field is taken.  rad.UtiDel alone only deletes the outer container.
+    Materials are not deleted, they are shared through the registry of radiamodels.util.
+    """
+    def tree (o):
+        children = _children(o)
+        objs = [o]
+        for child in children or []:
+            objs += tree(child)
+        return objs
+
+    # An object can be in more than one container
+    for o in dict.fromkeys(tree(obj)):
+        rad.UtiDel(o)
+    return
+
+
+def _centers_m (elements):
+    """
+    Center and magnetization of each element, (nelements, 3) arrays.  For a single element
+    radia returns [[x, y, z], [mx, my, mz]], anything else is not an element of get_elements.
+    """
+    rows = np.empty((len(elements), 6))
+    for i, e in enumerate(elements):
+        r = np.ravel(rad.ObjM(e))
+        if len(r) != 6:
+            raise ValueError(f'object {e} gives {len(r) // 6} magnetization rows, expected one for an element')
+        rows[i] = r
+    return rows[:, :3], rows[:, 3:]
+
+
+def get_magnetization (obj, elements=None):
+    """
+    Get the magnetization of all elements of a radia object, eg after rad.Solve
+
+    args:
+        obj: radia object
+        elements: elements of obj if already known (from get_elements)
+    returns:
+        (nelements, 3) float32 array of magnetization in T
+    """
+    if elements is None:
+        elements = get_elements(obj)
+
+    return _centers_m(elements)[1].astype(np.float32)
+
+
+def set_magnetization (obj, M, elements=None):
+    """
+    Set the magnetization of all elements of a radia object, eg as the starting point of rad.Solve.
+    The object must have the same element ordering as the one M was taken from, which is the
+    case for a model built by the same builder with only dimensions or positions changed.
+
+    args:
+        obj: radia object
+        M: (nelements, 3) array from get_magnetization
+        elements: elements of obj if already known (from get_elements)
+    """
+    if elements is None:
+        elements = get_elements(obj)
+
+    M = np.asarray(M, dtype=float).reshape(-1, 3)
+    if len(M) != len(elements):
+        raise ValueError(f'magnetization for {len(M)} elements but the object has {len(elements)}')
+
+    for e, m in zip(elements, M.tolist()):
+        rad.ObjSetM(e, m)
+    return
+
+
+def save_magnetization (fn, obj):
+    """Save the magnetization of all elements of a radia object to an npz file"""
+    np.savez_compressed(fn, m=get_magnetization(obj))
+    return
+
+
+def load_magnetization (fn, obj=None):
+    """
+    Load a magnetization saved by save_magnetization, and set it on obj if given
+
+    returns:
+        (nelements, 3) float32 array
+    """
+    with np.load(fn) as data:
+        M = data['m']
+    if obj is not None:
+        set_magnetization(obj, M)
+    return M
+
+
+def relax (obj, precision=0.0001, maxiter=10000, method=4, keep=True):
+    """
+    Relax obj as rad.Solve does, but with keep=True starting from the magnetization set on its
+    elements (RlxAuto with ZeroM->False) rather than from zero, eg after set_magnetization.
+
+    returns:
+        result of rad.RlxAuto, the last entry is the number of iterations as for rad.Solve
+    """
+    intrc = rad.RlxPre(obj)
+    try:
+        return rad.RlxAuto(intrc, precision, maxiter, method, 'ZeroM->' + ('False' if keep else 'True'))
+    finally:
+        rad.UtiDel(intrc)
+
+
+def warm_start (obj, tolerance=WARM_START_TOLERANCE):
+    """
+    Start obj from the magnetization of the last model remembered in this process, if that model
+    has the same elements: the same number, and no element center moved by more than tolerance
+    times the extent of the model (a neighbouring point of a sweep of the same builder).
+    Relax with relax(), rad.Solve starts from zero.
+
+    returns:
+        True if the magnetization was set
+    """
+    elements = get_elements(obj)
+    if _last is None or len(_last['m']) != len(elements):
+        return False
+
+    centers = _centers_m(elements)[0]
+    extent = np.max(np.ptp(centers, axis=0)) if len(centers) > 1 else 0
+    if np.max(np.linalg.norm(centers - _last['centers'], axis=1), initial=0) > tolerance * extent:
+        return False
+
+    set_magnetization(obj, _last['m'], elements)
+    return True
+
+
+def remember (obj):
+    """Remember the magnetization of obj as the starting point for the next warm_start"""
+    global _last
+    centers, M = _centers_m(get_elements(obj))
+    _last = {'m': M.astype(np.float32), 'centers': centers}
+    return
+
+
+def transfer_magnetization (src, dst):
+    """
+    Set the magnetization of dst from src, two models of the same geometry built by the same
+    builder but with a different segmentation.  The container trees are walked together and
+    where they differ (a block subdivided differently) each element of dst gets the
+    magnetization of the nearest element of the corresponding part of src.
+
+    args:
+        src: radia object, eg solved with a coarse segmentation
+        dst: radia object, eg the same model with a fine segmentation
+    """
+    src_children = _children(src)
+    dst_children = _children(dst)
+    if src_children is not None and dst_children is not None and len(src_children) == len(dst_children):
+        for s, d in zip(src_children, dst_children):
+            transfer_magnetization(s, d)
+        return
+
+    # Centers are in the coordinates of this part, the same for src and dst
+    src_centers, src_m = _centers_m(get_elements(src))
+    dst_elements = get_elements(dst)
+    centers = _centers_m(dst_elements)[0]
+
+    # in chunks so the distance matrix stays small
+    nearest = np.empty(len(centers), dtype=int)
+    for i in range(0, len(centers), 1000):
+        d2 = np.sum((centers[i:i+1000, None, :] - src_centers[None, :, :])**2, axis=-1)
+        nearest[i:i+1000] = np.argmin(d2, axis=1)
+    for e, m in zip(dst_elements, src_m[nearest].tolist()):
+        rad.ObjSetM(e, m)
+    return
+
+
+def solve_coarse_to_fine (builder, precision=0.0001, maxiter=10000, coarse=None, compare=False, debug=False,
+                          **params):
+    """
+    Build and solve builder(**params) starting from the magnetization of a coarsely segmented
+    version of the same model, so most of the relaxation iterations are done on the small problem.
+
+    args:
+        builder: function building the radia model, eg get_ivu, get_ivu_center
+        precision: solve precision (both levels)
+        maxiter: maximum solve iterations (per level)
+        coarse: builder arguments of the coarse level, default every *_divisions argument set to [1, 1, 1]
+        compare: also solve the fine model from zero, to measure the saving (cold_niter, cold_time)
+        debug: print the time per level
+        params: passed to builder
+    returns:
+        (model, report) with the fine model solved and a dict of the number of elements,
+        solve iterations and time per level (coarse, transfer, fine)
+    """
+    if coarse is None:
+        coarse = {k: [1, 1, 1] for k in inspect.signature(builder).parameters if k.endswith('_divisions')}
+
+    t0 = time.time()
+    model_coarse = builder(**dict(params, **coarse))
+    res_coarse = rad.Solve(model_coarse, precision, maxiter)
+    t1 = time.time()
+
+    model = builder(**params)
+    transfer_magnetization(model_coarse, model)
+    t2 = time.time()
+
+    # from the transferred magnetization, rad.Solve would start from zero
+    res = relax(model, precision, maxiter)
+    t3 = time.time()
+
+    # last entry of the solve result is the number of iterations
+    report = {
+        'coarse_elements': len(get_elements(model_coarse)),
+        'coarse_niter': int(res_coarse[-1]),
+        'coarse_time': t1 - t0,
+        'transfer_time': t2 - t1,
+        'fine_elements': len(get_elements(model)),
+        'fine_niter': int(res[-1]),
+        'fine_time': t3 - t2,
+    }
+    if debug: print(f"coarse {report['coarse_niter']} iterations {report['coarse_time']:.2f} s, "
+                    f"transfer {report['transfer_time']:.2f} s, "
+                    f"fine {report['fine_niter']} iterations {report['fine_time']:.2f} s")
+
+    if compare:
+        t0 = time.time()
+        res_cold = rad.Solve(builder(**params), precision, maxiter)
+        report['cold_niter'] = int(res_cold[-1])
+        report['cold_time'] = time.time() - t0
+        if debug: print(f"from zero {report['cold_niter']} iterations {report['cold_time']:.2f} s")
+
+    return model, report
@@ -1,4 +1,6 @@
 import radia as rad
+import radiamodels.util as ru
+import radiamodels.layout as rl
 
 import numpy as np
 
@@ -12,8 +14,26 @@ def get_ppmu (
     magnet_size_xy=[80, 40],
     magnet_divisions=[1, 1, 1],
     Br=1.25,
+    symmetric=True,
+    layout=None,
+    return_girders=False,
     debug=False
 ):
+    """
+    Get a pure permanent magnet undulator with a top and a bottom girder
+
+    With symmetric=True the bottom girder is not built explicitly but represented by a radia
+    symmetry, which is also imposed in the relaxation: the top girder rotated by pi about z with
+    the magnetization inverted, as the explicit bottom girder.  This holds for any layout, and
+    taper, tilt and elevation keep the two girders related by it.
+
+    layout is an optional girder layout (see radiamodels.layout) replacing the default one
+    of the top girder, eg a perturbed one.
+
+    With return_girders=True both girders are built explicitly and (undulator, girders) is
+    returned, girders a dict of the radia containers top and bottom, each placed by taper and
+    gap in the frame of the device (before tilt and elevation).
+    """
     # First magnet will be half length vertical, last will be half length vertical
 
     end_outer_length = 3 * period / 20
@@ -35,51 +55,44 @@ def get_ppmu (
     extrahalf_offset = period / 4 if nhalfperiods % 2 else 0
 
     # Magnet material
-    magnet_material = rad.MatStd('NdFeB', Br)
-
-    magnet_strengths = [
-        [0,  0, +1],
-        [0, -1,  0],
-        [0,  0, -1],
-        [0, +1,  0],
+    magnet_material = ru.get_material_std('NdFeB', Br)
 
-    ]
     magnet_color = [0, 0, 1]
 
-    girder_top = rad.ObjCnt([])
-    nmagnets = nhalfperiods * 2 + 1
-    for i in range(-2, nmagnets):
-        this_magnet_strength = magnet_strengths[i % 4]
-        this_magnet_center = [0, 0, -length / 2 + end_outer_length + end_inner_length + i * magnet_size[2] + magnet_size[2] / 2]
-        this_magnet_size = magnet_size
-        if i == -2:
-            this_magnet_center = [0, 0, -length / 2 + end_outer_length / 2]
-            this_magnet_size = magnet_size[0:2] + [end_outer_length]
-        elif i == -1:
-            this_magnet_center = [0, 0, -length / 2 + end_outer_length + end_inner_length / 2]
-            this_magnet_size = magnet_size[0:2] + [magnet_size[2]/2]
-        elif i == nmagnets - 2:
-            this_magnet_center = [0, 0, length / 2 - end_outer_length - end_inner_length / 2]
-            this_magnet_size = magnet_size[0:2] + [end_inner_length]
-            # print('end inner:', this_magnet_center, this_magnet_size)
-        elif i == nmagnets - 1:
-            this_magnet_center = [0, 0, length / 2 - end_outer_length / 2]
-            this_magnet_size = magnet_size[0:2] + [end_outer_length]
-            # print('end outer:', this_magnet_center, this_magnet_size)
-
-        # print('mag:', this_magnet_strength[1:], this_magnet_center[2], this_magnet_size[2])
-
-        magnet = rad.ObjFullMag(
-            this_magnet_center,
-            this_magnet_size,
-            this_magnet_strength,
-            magnet_divisions,
-            girder_top,
-            magnet_material,
-            magnet_color
-        )
+    # Layout of one girder, then all blocks built in one go
+    if layout is None:
+        layout = rl.get_girder_layout(nhalfperiods, period, magnet_size_xy, colors=[magnet_color])
+    girder_top = rl.build_layout(layout, {'NdFeB': magnet_material}, magnet_divisions)
 
         
+    if symmetric and not return_girders:
+        if debug: print('fast symmetric')
+
+        # Transform top
+        rad.TrfOrnt(girder_top, rad.TrfTrsl([0, +magnet_size[1]/2, 0]))
+
+        # Adjust for taper
+        phi_taper = np.arcsin(taper_mm_per_mm/2)
+        rad.TrfOrnt(girder_top, rad.TrfRot([0, 0, 0], [-1, 0, 0], phi_taper))
+
+        # Adjust for gap
+        rad.TrfOrnt(girder_top, rad.TrfTrsl([0, +gap/2, 0]))
+
+        # top -> bottom, rotated by pi about z and inverted as the explicit bottom girder
+        rad.TrfMlt(girder_top, rad.TrfCmbL(rad.TrfRot([0, 0, 0], [0, 0, 1], np.pi), rad.TrfInv()), 2)
+
+        # Build undulator, outside of the symmetry so tilt and elevation move the whole device
+        undulator = rad.ObjCnt([girder_top])
+
+        # Adjust for tilt
+        phi_tilt = np.arcsin(tilt_mm_per_mm)
+        rad.TrfOrnt(undulator, rad.TrfRot([0, 0, 0], [1, 0, 0], phi_tilt))
+
+        # Adjust for elevation
+        rad.TrfOrnt(undulator, rad.TrfTrsl([0, 0, elevation]))
+
+        return undulator
+
     girder_bot = rad.ObjDpl(girder_top)
 
     # Transform top
@@ -111,6 +124,9 @@ def get_ppmu (
     # Adjust for elevation
     rad.TrfOrnt(undulator, rad.TrfTrsl([0, 0, elevation]))
 
+    if return_girders:
+        return undulator, {'top': girder_top, 'bottom': girder_bot}
+
     return undulator
 
 
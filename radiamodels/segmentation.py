@@ -0,0 +1,192 @@
+import time
+import inspect
+import warnings
+import radia as rad
+import numpy as np
+
+import radiamodels.util as ru
+import radiamodels.field as rf
+import radiamodels.cache as rc
+import radiamodels.sweep as rs
+import radiamodels.magnetization as rm
+
+
+# Bytes of the interaction matrix per pair of elements, a 3x3 block of doubles
+MATRIX_BYTES_PER_PAIR = 9 * 8
+
+
+def get_division_classes (builder):
+    """Get the names and defaults of the *_divisions arguments of a builder"""
+    return {
+        k: v.default
+        for k, v in inspect.signature(builder).parameters.items()
+        if k.endswith('_divisions')
+    }
+
+
+def scale_divisions (divisions, factor):
+    """
+    Scale the number of divisions along each axis, keeping the [n, ratio] form of radia
+
+    eg scale_divisions([5, [5, 6], 5], 2) gives [10, [10, 6], 10]
+    """
+    scaled = []
+    for d in divisions:
+        if isinstance(d, (list, tuple)):
+            scaled.append([max(1, int(round(d[0] * factor)))] + list(d[1:]))
+        else:
+            scaled.append(max(1, int(round(d * factor))))
+    return scaled
+
+
+def get_candidates (divisions, factors=(0.5, 1, 2)):
+    """Candidate divisions from [1, 1, 1] to the finest, without duplicates"""
+    candidates = [[1, 1, 1]] + [scale_divisions(divisions, f) for f in sorted(factors)]
+    unique = []
+    for c in candidates:
+        if c not in unique:
+            unique.append(c)
+    return unique
+
+
+def matrix_bytes (nelements):
+    """Estimated memory of the relaxation interaction matrix for nelements elements"""
+    return MATRIX_BYTES_PER_PAIR * nelements**2
+
+
+def evaluate (builder, precision=0.0001, maxiter=10000, nperiods=2, npoints=500, nh=7, **params):
+    """
+    Build and solve one segmentation, the model is deleted afterwards
+
+    returns:
+        dict with beff, bn (amplitudes of the odd harmonics), nelements, memory (estimated
+        bytes), niter and time (build and solve)
+    """
+    period = rc.get_param(builder, params, 'period')
+
+    t0 = time.time()
+    model = builder(**params)
+    res = rad.Solve(model, precision, maxiter)
+    dt = time.time() - t0
+
+    Z = np.linspace(-nperiods*period/2, nperiods*period/2, npoints, endpoint=False)
+    B = rf.get_field_z(model, Z)
+    # free phase, the field is not sin-like about z=0 for every device (eg a pole at z=0)
+    beff, bn = ru.get_beff_bn_batch(Z, B[:, 1], period, nh=nh, free_phase=True)
+
+    nelements = len(rm.get_elements(model))
+    rm.delete_model(model)
+    return {
+        'beff': float(beff),
+        'bn': np.asarray(bn, dtype=float),
+        'nelements': nelements,
+        'memory': matrix_bytes(nelements),
+        # last entry of the solve result is the number of iterations
+        'niter': int(res[-1]),
+        'time': dt,
+    }
+
+
+def study_segmentation (
+    builder,
+    tolerance = 1e-3,
+    candidates = None,
+    precision = 0.0001,
+    maxiter = 10000,
+    nperiods = 2,
+    npoints = 500,
+    nworkers = None,
+    debug = False,
+    **params,
+):
+    """
+    Segmentation convergence study.  Each class of divisions (each *_divisions argument of the
+    builder) is refined on its own with all other classes at their finest candidate, and
+    compared to the reference with every class at its finest.  The recommended segmentation
+    takes for each class the coarsest candidate whose relative Beff change is within
+    tolerance / number of classes, and is then checked against the reference.  A class is
+    converged if a candidate coarser than its finest is within its share, otherwise the finest
+    is recommended without any evidence that it is itself within the tolerance, and a warning
+    is given.
+
+    args:
+        builder: function building the radia model, eg get_ivu, get_epu
+        tolerance: relative Beff tolerance of the recommended segmentation
+        candidates: dict of {class: list of divisions from coarse to fine}, by default
+                    get_candidates of the builder defaults for every class
+        precision, maxiter: solve parameters
+        nperiods, npoints: Beff region around z=0
+        nworkers: processes for the independent solves (see sweep.run_sweep)
+        debug: print progress
+        params: passed to builder
+    returns:
+        dict with
+            reference: result of evaluate at the finest segmentation
+            classes: {class: list of results of evaluate with divisions, dbeff and dbn added}
+            recommended: {class: divisions}
+            check: result for the recommended segmentation with dbeff and dbn
+            converged: {class: True if a coarser candidate is within its share}
+            converged_all: all classes converged and the check within tolerance
+    """
+    if candidates is None:
+        candidates = {k: get_candidates(params.get(k, v)) for k, v in get_division_classes(builder).items()}
+    finest = {k: c[-1] for k, c in candidates.items()}
+
+    # Reference, then every coarser candidate of every class
+    points = [dict(finest)]
+    for k, cs in candidates.items():
+        for c in cs[:-1]:
+            points.append(dict(finest, **{k: c}))
+
+    func_args = {'precision': precision, 'maxiter': maxiter, 'nperiods': nperiods, 'npoints': npoints}
+    results = rs.run_sweep(builder, points, base_params=params, func=evaluate, func_args=func_args,
+                           nworkers=nworkers, debug=debug)
+
+    reference = results[0]
+
+    def compare (result):
+        result = dict(result)
+        result['dbeff'] = abs(result['beff'] / reference['beff'] - 1)
+        result['dbn'] = float(np.max(np.abs(result['bn'] - reference['bn']))) / abs(reference['beff'])
+        return result
+
+    classes = {}
+    i = 1
+    for k, cs in candidates.items():
+        classes[k] = [dict(compare(r), divisions=c) for c, r in zip(cs[:-1], results[i:i+len(cs)-1])]
+        classes[k].append(dict(compare(reference), divisions=cs[-1]))
+        i += len(cs) - 1
+
+    # Coarsest candidate of each class within its share of the tolerance
+    share = tolerance / max(1, len(candidates))
+    recommended = {k: next(r['divisions'] for r in levels if r['dbeff'] <= share) for k, levels in classes.items()}
+    # The finest is always within its share of itself, so it only counts with a single candidate
+    converged = {k: len(levels) == 1 or any(r['dbeff'] <= share for r in levels[:-1]) for k, levels in classes.items()}
+    if debug:
+        for k, levels in classes.items():
+            for r in levels:
+                print(f"{k:30s} {str(r['divisions']):20s} dbeff {r['dbeff']:.2e} "
+                      f"{r['nelements']:7d} elements {r['memory']/1e9:7.3f} GB {r['time']:8.2f} s")
+        print('recommended:', recommended)
+        print('converged:', converged)
+
+    if recommended == finest:
+        check = compare(reference)
+    else:
+        check = compare(evaluate(builder, **func_args, **dict(params, **recommended)))
+
+    not_converged = [k for k, c in converged.items() if not c]
+    if not_converged:
+        warnings.warn(f'segmentation not converged to {tolerance} for {not_converged}, '
+                      'the finest candidates are recommended, add finer candidates')
+    if check['dbeff'] > tolerance:
+        warnings.warn(f"recommended segmentation has dbeff {check['dbeff']:.2e} over the tolerance {tolerance}")
+
+    return {
+        'reference': reference,
+        'classes': classes,
+        'recommended': recommended,
+        'check': check,
+        'converged': converged,
+        'converged_all': not not_converged and check['dbeff'] <= tolerance,
+    }
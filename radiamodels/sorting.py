@@ -0,0 +1,367 @@
+import math
+import numpy as np
+
+import radiamodels.util as ru
+import radiamodels.cache as rc
+import radiamodels.errors as rerr
+import radiamodels.integrals as rint
+
+
+# Default tolerance of each term of the objective, each term contributes mean((value / tolerance)^2)
+TOLERANCES = {
+    'i1': 0.05,          # first field integrals at the exit in T mm (50 G cm)
+    'i2': 5.0,           # second field integrals at the exit in T mm^2
+    'trajectory': 5.0,   # second integrals at the poles minus a straight line in T mm^2
+    'phase': 2.0,        # phase at the poles minus a straight line in degrees
+}
+
+
+def read_blocks (fn):
+    """
+    Read measured blocks from a CSV file with a header line and the columns
+        name, mx, my, mz [, axis]
+    where mz is the magnetization in T along the easy axis and mx, my the transverse components,
+    in the frame of the block as placed in a slot (see slot_frames).  The optional axis column
+    (x, y or z) is the block dimension along which it is magnetized, blocks are then only
+    placed in slots with the same easy axis.
+
+    returns:
+        dict with name, m (nblocks, 3) and axis (None if not given)
+    """
+    data = np.atleast_1d(np.genfromtxt(fn, delimiter=',', names=True, dtype=None, encoding='utf-8',
+                                       autostrip=True))
+    return {
+        'name': np.asarray(data['name']).astype(str),
+        'm': np.column_stack([data['mx'], data['my'], data['mz']]).astype(float),
+        'axis': np.asarray(data['axis']).astype(str) if 'axis' in data.dtype.names else None,
+    }
+
+
+def slot_frames (layout):
+    """
+    Frame of each block of a layout, the columns are the transverse directions e1, e2 and the
+    easy axis, so a magnetization m in the frame of the block is frames @ m in the device
+    """
+    d = layout['mdir'] / np.linalg.norm(layout['mdir'], axis=1, keepdims=True)
+    e1, e2 = rerr._perpendicular(d)
+    return np.stack([e1, e2, d], axis=-1)
+
+
+def _line_projection (X):
+    """Matrix removing the best straight line through values sampled at X"""
+    A = np.column_stack([X, np.ones(len(X))])
+    return np.eye(len(X)) - A @ np.linalg.pinv(A)
+
+
+def _term_rows (F, Z, I10, poles, k):
+    """
+    Terms of the objective for fields F with shape (3, n, len(Z)), linear in F
+
+    args:
+        F: field of n unit changes along Z in T
+        Z: z positions in mm
+        I10: nominal first integrals (3, len(Z)) in T mm, the phase is linearized about them
+        poles: indices into Z
+        k: 2 pi / (period (1 + K^2 / 2)) in 1/m
+    returns:
+        dict of {term: (nvalues, n)}
+    """
+    I1 = rint.cumtrapz(F[:2], Z)
+    I2 = rint.cumtrapz(I1, Z)
+    Q = _line_projection(Z[poles])
+
+    # d phase = k 2 / (mc/e)^2 int I1 dI1 dz in SI units
+    dslip = rint.cumtrapz(np.einsum('cp,cnp->np', I10[:2] / 1000, I1 / 1000), Z / 1000)
+
+    return {
+        'i1': I1[..., -1],
+        'i2': I2[..., -1],
+        'trajectory': np.einsum('qp,cnp->cqn', Q, I2[..., poles]).reshape(-1, F.shape[1]),
+        'phase': np.degrees(k * 2 / rerr.MC_OVER_E**2 * Q @ dslip[:, poles].T),
+    }
+
+
+def get_operator (builder, tolerances=None, shim=None, zmargin=500, points_per_period=20, nperiods=2, **params):
+    """
+    Linear model of the sorting objective of an EPU or PPMU, for the ideal device from
+    errors.get_device_layout.  All terms are linear in the block magnetizations (the phase
+    linearized about the ideal device) and stacked into one residual vector v scaled by the
+    tolerances, so the objective is |v|^2.  The regular blocks are the slots to sort, the
+    end pieces stay nominal.
+
+    args:
+        builder: get_epu or get_ppmu
+        tolerances: dict updating TOLERANCES, a term with tolerance None is left out
+        shim: if given, displacement in mm for the finite difference shim response
+        zmargin: length in mm sampled beyond both ends of the device
+        points_per_period: z samples per period
+        nperiods: number of periods around z=0 for K
+        params: builder arguments, taper, tilt and elevation must be 0 (see errors.get_device_layout)
+    returns:
+        dict with
+            layout, slots (indices into layout), axis (easy axis x, y or z of each slot)
+            H: (nslots, len(v), 3) change of v per unit magnetization in the frame of the slot
+            S: (nslots, len(v)) change of v per mm of shim of each slot, if shim is given
+            v0: v of the ideal device
+            m0: nominal magnetization in the frame of a block, [0, 0, Br]
+            terms: {term: slice of v}
+    """
+    tol = dict(TOLERANCES)
+    tol.update(tolerances or {})
+
+    period = rc.get_param(builder, params, 'period')
+    Br = rc.get_param(builder, params, 'Br')
+    layout, _ = rerr.get_device_layout(builder, **params)
+    slots = np.nonzero(np.isclose(layout['size'][:, 2], period / 4))[0]
+
+    # z grid on multiples of the step, so the Beff window around z=0 is on the grid
+    dz = period / points_per_period
+    zend = np.max(np.abs(layout['center'][:, 2]) + layout['size'][:, 2] / 2)
+    n = int(np.ceil((zend + zmargin) / dz))
+    Z = np.arange(-n, n + 1) * dz
+    window = slice(n - nperiods * points_per_period // 2, n + nperiods * points_per_period // 2)
+
+    # Response with shape (3, nblocks, 3, len(Z))
+    R = np.moveaxis(rerr.get_response(layout, Z), 0, -1)
+    M0 = Br * layout['mdir']
+    B0 = np.einsum('cbjp,bj->cp', R, M0)
+    I10 = rint.cumtrapz(B0, Z)
+
+    beff = float(ru.get_beff_bn_batch(Z[window], B0[1, window], period, free_phase=True)[0])
+    K = ru.b2k_mm(beff, period)
+    k = 2 * np.pi / (period / 1000 * (1 + K**2 / 2))
+    poles = rerr.get_poles(Z, B0[1])
+    # leave out the ends, which are not periodic
+    poles = poles[2:-2] if len(poles) > 8 else poles
+
+    # Values of the ideal device, the phase itself is not linear
+    I20 = rint.cumtrapz(I10, Z)
+    Q = _line_projection(Z[poles])
+    slip = rint.cumtrapz(np.sum((I10[:2] / 1000 / rerr.MC_OVER_E)**2, axis=0), Z / 1000)
+    values = {
+        'i1': I10[:2, -1],
+        'i2': I20[:2, -1],
+        'trajectory': (I20[:2, poles] @ Q.T).ravel(),
+        'phase': np.degrees(Q @ (k * (Z / 1000 + slip))[poles]),
+    }
+
+    rows = _term_rows(R[:, slots].reshape(3, -1, len(Z)), Z, I10, poles, k)
+
+    if shim is not None:
+        # Slots moved vertically away from the gap
+        shifted = layout[slots].copy()
+        shifted['center'][:, 1] += shim * np.sign(shifted['center'][:, 1])
+        Rs = np.moveaxis(rerr.get_response(shifted, Z), 0, -1)
+        dB = np.einsum('csjp,sj->csp', Rs - R[:, slots], M0[slots]) / shim
+        shim_rows = _term_rows(dB, Z, I10, poles, k)
+
+    # Stack the terms, each scaled so it contributes mean((value / tolerance)^2)
+    G, S, v0 = [], [], []
+    terms = {}
+    start = 0
+    for name in TOLERANCES:
+        if tol[name] is None:
+            continue
+        scale = 1 / (tol[name] * np.sqrt(np.size(values[name])))
+        G.append(rows[name].reshape(-1, len(slots), 3) * scale)
+        if shim is not None:
+            S.append(shim_rows[name].reshape(-1, len(slots)) * scale)
+        v0.append(np.ravel(values[name]) * scale)
+        terms[name] = slice(start, start + len(v0[-1]))
+        start += len(v0[-1])
+
+    # From the device frame to the frame of each slot, contiguous per slot for the moves
+    frames = slot_frames(layout[slots])
+    H = np.ascontiguousarray(np.einsum('lsj,sjk->slk', np.concatenate(G), frames))
+
+    op = {
+        'layout': layout,
+        'slots': slots,
+        'axis': np.array(['xyz'[i] for i in np.argmax(np.abs(layout['mdir'][slots]), axis=1)]),
+        'H': H,
+        'v0': np.concatenate(v0),
+        'm0': np.array([0, 0, Br], dtype=float),
+        'terms': terms,
+    }
+    if shim is not None:
+        op['S'] = np.ascontiguousarray(np.concatenate(S).T)
+    return op
+
+
+def get_residual (op, blocks, assignment, flips=None):
+    """
+    Residual vector v for blocks placed in the slots
+
+    args:
+        op: from get_operator
+        blocks: from read_blocks
+        assignment: block index in each slot
+        flips: optional bool per slot, block rotated by pi about its easy axis
+    """
+    m = blocks['m'][assignment].copy()
+    if flips is not None:
+        m[flips, :2] *= -1
+    return op['v0'] + np.einsum('slk,sk->l', op['H'], m - op['m0'])
+
+
+def evaluate (op, v):
+    """Each term as the RMS of its values over their tolerance, and the objective |v|^2"""
+    result = {name: float(np.sqrt(np.sum(v[s]**2))) for name, s in op['terms'].items()}
+    result['objective'] = float(v @ v)
+    return result
+
+
+def _pools (op, blocks):
+    """Slots and candidate blocks of each easy axis, a single pool if blocks have no axis"""
+    if blocks['axis'] is None:
+        pools = [(np.arange(len(op['slots'])), np.arange(len(blocks['m'])))]
+    else:
+        pools = [(np.nonzero(op['axis'] == axis)[0], np.nonzero(blocks['axis'] == axis)[0])
+                 for axis in np.unique(op['axis'])]
+
+    for slots, candidates in pools:
+        if len(candidates) < len(slots):
+            raise ValueError(f'{len(slots)} slots but only {len(candidates)} blocks for them')
+    return pools
+
+
+def anneal (op, blocks, nmoves=1000000, t_start=None, t_stop=None, flips=False, seed=None, debug=False):
+    """
+    Sort measured blocks into the slots by simulated annealing.  A move swaps the blocks of
+    two slots, puts a spare block into a slot or, with flips, rotates a block by pi about
+    its easy axis.  The residual vector is updated from the columns of the slots involved
+    only, so a move costs O(len(v)) whatever the size of the device.
+
+    args:
+        op: from get_operator
+        blocks: from read_blocks, at least as many blocks as slots of each easy axis
+        nmoves: number of moves
+        t_start, t_stop: temperatures of the geometric cooling schedule, by default from the
+                         objective change of random moves
+        flips: also try rotating blocks by pi about their easy axis
+        seed: random seed
+        debug: print progress
+    returns:
+        dict with assignment (block index per slot), flips (per slot), the residual v and
+        evaluate() of the initial and final states
+    """
+    rng = np.random.default_rng(seed)
+    H = op['H']
+    # Change from nominal of each block, as measured and flipped
+    dM = [blocks['m'] - op['m0'], blocks['m'] * [-1, -1, 1] - op['m0']]
+
+    # Random initial assignment
+    pools = _pools(op, blocks)
+    order = [rng.permutation(candidates) for slots, candidates in pools]
+    assignment = np.empty(len(op['slots']), dtype=int)
+    for (slots, candidates), o in zip(pools, order):
+        assignment[slots] = o[:len(slots)]
+    flipped = np.zeros(len(op['slots']), dtype=int)
+
+    v = get_residual(op, blocks, assignment, flipped.astype(bool))
+    initial = evaluate(op, v)
+
+    if t_start is None or t_stop is None:
+        s = rng.integers(len(assignment), size=100)
+        b = rng.integers(len(blocks['m']), size=100)
+        dv = np.einsum('nlk,nk->nl', H[s], dM[0][b] - dM[0][assignment[s]])
+        scale = float(np.median(np.abs(2 * dv @ v + np.sum(dv**2, axis=1)))) or 1.0
+        t_start = scale if t_start is None else t_start
+        t_stop = scale * 1e-4 if t_stop is None else t_stop
+    cooling = (t_stop / t_start) ** (1 / max(1, nmoves))
+
+    T = t_start
+    cost = float(v @ v)
+    batch = 100000
+    for start in range(0, nmoves, batch):
+        # Random numbers for a batch of moves at once, much faster than calls per move
+        n = min(batch, nmoves - start)
+        pick = rng.random((n, 5)).tolist()
+        for r_pool, r_i, r_j, r_flip, r_accept in pick:
+            T *= cooling
+            p = int(r_pool * len(pools))
+            slots, o = pools[p][0], order[p]
+            i = int(r_i * len(slots))
+            s = slots[i]
+            a = o[i]
+
+            # its own random number, so the partner j is uniform over the pool
+            if flips and r_flip < 0.2:
+                # flip the block of slot s
+                j = None
+                dv = H[s] @ (dM[1 - flipped[s]][a] - dM[flipped[s]][a])
+            else:
+                j = int(r_j * len(o))
+                if j == i:
+                    continue
+                b = o[j]
+                dv = H[s] @ (dM[flipped[s]][b] - dM[flipped[s]][a])
+                if j < len(slots):
+                    # swap with another slot, otherwise a spare block goes into slot s
+                    t = slots[j]
+                    dv += H[t] @ (dM[flipped[t]][a] - dM[flipped[t]][b])
+
+            delta = 2 * float(v @ dv) + float(dv @ dv)
+            if delta < 0 or r_accept < math.exp(-delta / T):
+                v += dv
+                cost += delta
+                if j is None:
+                    flipped[s] = 1 - flipped[s]
+                else:
+                    o[i], o[j] = o[j], o[i]
+                    assignment[s] = o[i]
+                    if j < len(slots):
+                        assignment[slots[j]] = o[j]
+
+        if debug: print(f'move {start + n} T {T:.3e} objective {cost:.4e}')
+
+    # The exact sum again, without the rounding accumulated over the moves
+    v = get_residual(op, blocks, assignment, flipped.astype(bool))
+    return {
+        'assignment': assignment,
+        'flips': flipped.astype(bool),
+        'v': v,
+        'initial': initial,
+        'final': evaluate(op, v),
+    }
+
+
+def optimize_shims (op, v, shims=(0, 0.05, 0.1, 0.15, 0.2), nsweeps=20, debug=False):
+    """
+    Select a vertical shim for each slot from a set of displacements to reduce the objective,
+    by coordinate descent on the linear shim response of get_operator(..., shim=dy).
+
+    args:
+        op: from get_operator with shim
+        v: residual vector before shimming, eg from anneal
+        shims: available displacements in mm away from the gap
+        nsweeps: maximum sweeps over all slots
+        debug: print the objective after each sweep
+    returns:
+        (shim per slot in mm, residual vector with the shims)
+    """
+    if 'S' not in op:
+        raise ValueError('no shim response, use get_operator with shim')
+
+    S = op['S']
+    shims = np.asarray(shims, dtype=float)
+    norm2 = np.sum(S**2, axis=1)
+    selected = np.zeros(len(S))
+    v = v.copy()
+
+    for sweep in range(nsweeps):
+        changed = False
+        for s in range(len(S)):
+            # objective change of every displacement of this slot
+            d = shims - selected[s]
+            delta = 2 * d * float(S[s] @ v) + d**2 * norm2[s]
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-15:
+                v += d[best] * S[s]
+                selected[s] = shims[best]
+                changed = True
+        if debug: print(f'sweep {sweep} objective {v @ v:.4e}')
+        if not changed:
+            break
+
+    return selected, v
@@ -0,0 +1,150 @@
+import os
+import time
+import json
+import uuid
+import numpy as np
+
+
+# A store is a directory of chunk files.  Each chunk is an npz file with one array per column,
+# all with the same number of rows.  Appending only ever adds a new chunk under a unique name
+# (written to a temporary file and renamed), so several processes can append at the same time.
+CHUNK_PREFIX = 'chunk-'
+META_NAME = 'meta.json'
+
+
+def _chunk_files (path):
+    if not os.path.isdir(path):
+        return []
+    return [
+        os.path.join(path, fn)
+        for fn in sorted(os.listdir(path))
+        if fn.startswith(CHUNK_PREFIX) and fn.endswith('.npz')
+    ]
+
+
+def flatten_row (*dicts):
+    """
+    Merge dicts of parameters and results into one row of {column: value}.
+    Nested dicts give columns named outer.inner, anything that is not a number, string
+    or array-like of numbers is dropped.
+    """
+    row = {}
+    for d in dicts:
+        for k, v in d.items():
+            if isinstance(v, dict):
+                for kk, vv in flatten_row(v).items():
+                    row[f'{k}.{kk}'] = vv
+                continue
+            a = np.asarray(v)
+            if a.dtype.kind in 'biufcU':
+                row[k] = a
+    return row
+
+
+def _stack (name, values):
+    """Stack the values of one column, which must all have the same shape"""
+    shapes = sorted(set(v.shape for v in values))
+    if len(shapes) > 1:
+        raise ValueError(f'column {name} has values of different shapes {shapes}, a store only holds '
+                         'columns with the same shape in every row')
+    return np.stack(values)
+
+
+def append (path, rows=None, columns=None):
+    """
+    Append rows to a store, creating it if needed
+
+    args:
+        path: store directory
+        rows: list of dicts of {column: value}, eg from flatten_row
+        columns: or a dict of {column: array} where all arrays have the same length
+    returns:
+        name of the chunk file written
+    """
+    if columns is None:
+        names = sorted(set().union(*[r.keys() for r in rows]))
+        missing = [n for n in names if any(n not in r for r in rows)]
+        if missing:
+            raise ValueError(f'all rows must have the same columns, missing in some rows: {missing}')
+        columns = {n: _stack(n, [np.asarray(r[n]) for r in rows]) for n in names}
+
+    columns = {k: np.asarray(v) for k, v in columns.items()}
+    lengths = set(len(v) for v in columns.values())
+    if len(lengths) > 1:
+        raise ValueError(f'columns have different lengths: {lengths}')
+
+    os.makedirs(path, exist_ok=True)
+    name = f'{CHUNK_PREFIX}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz'
+    tmp = os.path.join(path, f'.{name}.tmp')
+    with open(tmp, 'wb') as fo:
+        np.savez(fo, **columns)
+    os.replace(tmp, os.path.join(path, name))
+    return name
+
+
+def get_columns (path):
+    """Get the names of all columns in a store"""
+    names = set()
+    for fn in _chunk_files(path):
+        with np.load(fn) as data:
+            names.update(data.files)
+    return sorted(names)
+
+
+def read (path, columns=None):
+    """
+    Read columns from a store.  Only the requested columns are loaded from each chunk.
+
+    args:
+        path: store directory
+        columns: list of column names, or None for all columns
+    returns:
+        dict of {column: array} with the rows of all chunks in the order they were appended
+    """
+    if columns is None:
+        columns = get_columns(path)
+
+    parts = {c: [] for c in columns}
+    for fn in _chunk_files(path):
+        with np.load(fn) as data:
+            for c in columns:
+                if c not in data.files:
+                    raise KeyError(f'column {c} missing in {fn}')
+                parts[c].append(data[c])
+
+    for c, p in parts.items():
+        shapes = sorted(set(a.shape[1:] for a in p))
+        if len(shapes) > 1:
+            raise ValueError(f'column {c} has rows of different shapes {shapes} in different chunks')
+
+    return {c: np.concatenate(p) if p else np.array([]) for c, p in parts.items()}
+
+
+def compact (path):
+    """Merge all chunks of a store into one"""
+    chunks = _chunk_files(path)
+    if len(chunks) < 2:
+        return
+    append(path, columns=read(path))
+    for fn in chunks:
+        os.remove(fn)
+    return
+
+
+def write_meta (path, meta):
+    """Write a dict of json-able metadata describing the store, eg the fixed parameters"""
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, f'.{META_NAME}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as fo:
+        json.dump(meta, fo, indent=4)
+    os.replace(tmp, os.path.join(path, META_NAME))
+    return
+
+
+def read_meta (path):
+    """Read the metadata of a store, {} if there is none"""
+    fn = os.path.join(path, META_NAME)
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as fi:
+        return json.load(fi)
@@ -0,0 +1,431 @@
+import os
+import time
+import json
+import itertools
+import functools
+import multiprocessing
+import numpy as np
+
+import radiamodels.cache as rc
+import radiamodels.store as rst
+
+
+# Environment variables set by the common MPI launchers
+MPI_ENVIRONMENT = ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'PMIX_RANK', 'MPI_LOCALNRANKS')
+
+# MPI message tags for the master/worker queue
+TAG_WORK = 1
+TAG_STOP = 2
+
+# Chunks of contiguous points per worker with warm start, more balances the load better
+WARM_START_CHUNKS = 4
+
+# Model inherited by forked map_model workers
+_model = None
+
+
+def make_grid (**axes):
+    """
+    Get the points of a multi-dimensional grid over builder arguments
+
+    eg make_grid(gap=[5, 6, 7], pole_offset_y=[0, 1]) gives 6 points with the last axis varying fastest
+
+    returns:
+        list of dicts of {argument: value}
+    """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*[list(axes[n]) for n in names])]
+
+
+def order_points (points):
+    """
+    Order points so that each one is close to the previous one (greedy nearest neighbour over
+    the numeric arguments, each scaled by its range), eg so a relaxation can start from the
+    magnetization of the previous point.
+
+    returns:
+        list of indices into points
+    """
+    points = list(points)
+    if len(points) < 3:
+        return list(range(len(points)))
+
+    names = sorted(set().union(*[p.keys() for p in points]))
+    columns = []
+    for n in names:
+        values = [p.get(n) for p in points]
+        try:
+            column = np.asarray(values, dtype=float).reshape(len(points), -1)
+        except (TypeError, ValueError):
+            # not numeric, only equal or not
+            labels = {repr(v): i for i, v in enumerate(dict.fromkeys(repr(v) for v in values))}
+            column = np.array([[labels[repr(v)]] for v in values], dtype=float)
+        span = np.ptp(column, axis=0)
+        columns.append(column / np.where(span > 0, span, 1))
+    X = np.hstack(columns)
+
+    order = [0]
+    todo = np.ones(len(points), dtype=bool)
+    todo[0] = False
+    for i in range(1, len(points)):
+        d = np.sum((X - X[order[-1]])**2, axis=1)
+        d[~todo] = np.inf
+        order.append(int(np.argmin(d)))
+        todo[order[-1]] = False
+    return order
+
+
+def in_mpi ():
+    """True if the process looks like it was started by an MPI launcher"""
+    return any(k in os.environ for k in MPI_ENVIRONMENT)
+
+
+def run_point (point, builder, base_params=None, func=None, func_args=None):
+    """
+    Evaluate a single point: func(builder, **func_args, **base_params, **point)
+
+    func defaults to cache.solve_beff
+    """
+    params = dict(base_params or {})
+    params.update(point)
+    if func is None:
+        func = rc.solve_beff
+    return func(builder, **(func_args or {}), **params)
+
+
+def point_key (builder, point, base_params=None, func=None, func_args=None):
+    """Hash identifying the result of a sweep point"""
+    params = dict(base_params or {})
+    params.update(point)
+    return rc.param_hash(builder, params, func=func or rc.solve_beff, func_args=func_args or {})
+
+
+def _to_json (value):
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _from_json (value):
+    if isinstance(value, dict):
+        if '__ndarray__' in value:
+            return np.asarray(value['__ndarray__'], dtype=value['dtype'])
+        return {k: _from_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    return value
+
+
+def load_checkpoint (fn):
+    """
+    Read the completed points of a sweep checkpoint
+
+    returns:
+        dict of {key: result}
+    """
+    done = {}
+    if not os.path.exists(fn):
+        return done
+    with open(fn) as fi:
+        for line in fi:
+            # A job killed while writing leaves a partial last line, that point is simply redone
+            # and the line is removed by the next write_checkpoint
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done[record['key']] = _from_json(record['result'])
+    return done
+
+
+def _truncate_partial_line (fo, block=4096):
+    """Cut a file open for appending back to its last newline, dropping a partial last line"""
+    end = fo.seek(0, os.SEEK_END)
+    pos = end
+    while pos > 0:
+        start = max(0, pos - block)
+        fo.seek(start)
+        data = fo.read(pos - start)
+        if pos == end and data.endswith(b'\n'):
+            return
+        i = data.rfind(b'\n')
+        if i >= 0:
+            fo.truncate(start + i + 1)
+            return
+        pos = start
+    fo.truncate(0)
+    return
+
+
+def write_checkpoint (fn, key, point, result):
+    """
+    Append one completed point to a sweep checkpoint.  A partial last line left by a job
+    killed while writing is removed first, so it does not corrupt this record too.
+    """
+    line = json.dumps({'key': key, 'point': _to_json(point), 'result': _to_json(result)})
+    with open(fn, 'a+b') as fo:
+        _truncate_partial_line(fo)
+        fo.write((line + '\n').encode())
+        fo.flush()
+        os.fsync(fo.fileno())
+    return
+
+
+def _run_task (task, run):
+    index, point = task
+    t0 = time.time()
+    result = run(point)
+    return index, result, time.time() - t0
+
+
+def _run_chunk (chunk, run):
+    return [_run_task(task, run) for task in chunk]
+
+
+def _chunks (tasks, nworkers, warm_start=False):
+    """
+    One task per chunk, or with warm_start contiguous runs of the ordered tasks (a few per
+    worker) so that consecutive neighbouring points are run by the same process
+    """
+    if not warm_start:
+        return [[task] for task in tasks]
+    size = max(1, -(-len(tasks) // (WARM_START_CHUNKS * max(1, nworkers))))
+    return [tasks[i:i+size] for i in range(0, len(tasks), size)]
+
+
+def run_sweep (
+    builder,
+    points,
+    base_params=None,
+    func=None,
+    func_args=None,
+    nworkers=None,
+    mpi=None,
+    callback=None,
+    checkpoint=None,
+    resume=True,
+    store=None,
+    store_chunk=1,
+    store_meta=None,
+    warm_start=False,
+    debug=False,
+):
+    """
+    Run func over all points, scheduling them dynamically over a local process pool or MPI ranks.
+    Workers are handed a new point as soon as they finish one, so the number of points is
+    independent of the number of workers.
+
+    args:
+        builder: function building the radia model, eg get_ivu, get_epu, get_ppmu
+        points: list of dicts of builder arguments to change, eg from make_grid
+        base_params: dict of builder arguments common to all points
+        func: func(builder, **func_args, **params) evaluated at each point (default cache.solve_beff).
+              Must be picklable (defined at module level) when nworkers > 1.
+        func_args: dict of extra arguments to func
+        nworkers: number of local processes (default os.cpu_count()), 1 runs in this process
+        mpi: True to use MPI ranks (rank 0 distributes the work), None to detect an MPI launcher
+        callback: callback(index, point, result) called in the main process as each result arrives
+        checkpoint: file to which each result is appended as soon as it arrives
+        resume: if True points already in checkpoint are not run again
+        store: columnar store directory (see radiamodels.store) to which the swept parameters
+               and results are appended as they arrive
+        store_chunk: number of results per chunk appended to store
+        store_meta: dict of json-able metadata added to the meta of store (with the builder and
+                    base_params), written when the store is opened so a store of an interrupted
+                    run has it too
+        warm_start: run the points in nearest neighbour order (see order_points) and pass
+                    warm_start=True to func, so each worker starts a relaxation from the
+                    magnetization of its previous point (supported by cache.solve_beff).
+                    Workers get contiguous runs of the ordered points, WARM_START_CHUNKS
+                    per worker, rather than one point at a time
+        debug: print progress
+    returns:
+        list of results in the order of points (None on MPI ranks other than 0)
+    """
+    points = list(points)
+    # warm start changes the starting point, not the result, so it is not in the checkpoint keys
+    run_args = dict(func_args or {}, warm_start=True) if warm_start else func_args
+    run = functools.partial(run_point, builder=builder, base_params=base_params, func=func, func_args=run_args)
+    results = [None] * len(points)
+    tasks = list(enumerate(points))
+    if warm_start:
+        tasks = [tasks[i] for i in order_points(points)]
+
+    if mpi is None:
+        mpi = in_mpi()
+
+    if checkpoint is not None:
+        keys = [point_key(builder, p, base_params, func, func_args) for p in points]
+        done = load_checkpoint(checkpoint) if resume else {}
+        for index, point in enumerate(points):
+            if keys[index] in done:
+                results[index] = done[keys[index]]
+        tasks = [(index, point) for index, point in tasks if keys[index] not in done]
+        if debug: print(f'{len(points) - len(tasks)} of {len(points)} points already in {checkpoint}')
+
+        user_callback = callback
+
+        def callback (index, point, result, user_callback=user_callback):
+            write_checkpoint(checkpoint, keys[index], point, result)
+            if user_callback is not None:
+                user_callback(index, point, result)
+
+    store_rows = []
+
+    def flush_store ():
+        if not store_rows:
+            return
+        rst.append(store, store_rows)
+        store_rows.clear()
+
+    if store is not None:
+        # meta when the store is opened, a run may be interrupted or a resumed one append nothing
+        meta = dict(store_meta or {}, **{
+            'builder': rc.canonicalize(builder),
+            'base_params': rc.canonicalize(base_params or {}),
+        })
+        existing = rst.read_meta(store)
+        if any(k not in existing for k in meta):
+            rst.write_meta(store, dict(meta, **existing))
+
+        store_callback = callback
+
+        def callback (index, point, result, store_callback=store_callback):
+            row = result if isinstance(result, dict) else {'result': result}
+            store_rows.append(rst.flatten_row({'index': index}, point, row))
+            if len(store_rows) >= store_chunk:
+                flush_store()
+            if store_callback is not None:
+                store_callback(index, point, result)
+
+    if mpi:
+        results = _run_mpi(tasks, run, results, callback, debug, warm_start)
+        if results is not None and store is not None:
+            flush_store()
+        return results
+
+    if nworkers is None:
+        nworkers = os.cpu_count()
+    nworkers = max(1, min(nworkers, len(tasks)))
+
+    def collect (index, result, dt):
+        results[index] = result
+        if debug: print(f'point {index} done in {dt:.2f} s: {points[index]}')
+        if callback is not None:
+            callback(index, points[index], result)
+
+    if nworkers == 1:
+        for task in tasks:
+            collect(*_run_task(task, run))
+    else:
+        # chunksize 1 so that every idle worker immediately gets the next chunk
+        chunks = _chunks(tasks, nworkers, warm_start)
+        with multiprocessing.Pool(nworkers) as pool:
+            for done in pool.imap_unordered(functools.partial(_run_chunk, run=run), chunks, chunksize=1):
+                for index, result, dt in done:
+                    collect(index, result, dt)
+
+    if store is not None:
+        flush_store()
+    return results
+
+
+def _run_mpi (tasks, run, results, callback=None, debug=False, warm_start=False):
+    """Master/worker queue of chunks of tasks over MPI ranks, rank 0 is the master and fills results"""
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # Nobody to hand work to, just run everything here
+    if size == 1:
+        for task in tasks:
+            index, result, dt = _run_task(task, run)
+            results[index] = result
+            if callback is not None:
+                callback(index, task[1], result)
+        return results
+
+    status = MPI.Status()
+
+    if rank != 0:
+        while True:
+            chunk = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == TAG_STOP:
+                return None
+            comm.send(_run_chunk(chunk, run), dest=0, tag=TAG_WORK)
+
+    chunks = _chunks(tasks, size - 1, warm_start)
+    points = dict(tasks)
+    next_chunk = 0
+    active = 0
+
+    # Give every worker a first chunk, or tell it to stop if there are more workers than chunks
+    for worker in range(1, size):
+        if next_chunk < len(chunks):
+            comm.send(chunks[next_chunk], dest=worker, tag=TAG_WORK)
+            next_chunk += 1
+            active += 1
+        else:
+            comm.send(None, dest=worker, tag=TAG_STOP)
+
+    while active:
+        done = comm.recv(source=MPI.ANY_SOURCE, tag=TAG_WORK, status=status)
+        worker = status.Get_source()
+        for index, result, dt in done:
+            results[index] = result
+            if debug: print(f'point {index} done by rank {worker} in {dt:.2f} s: {points[index]}')
+            if callback is not None:
+                callback(index, points[index], result)
+
+        if next_chunk < len(chunks):
+            comm.send(chunks[next_chunk], dest=worker, tag=TAG_WORK)
+            next_chunk += 1
+        else:
+            comm.send(None, dest=worker, tag=TAG_STOP)
+            active -= 1
+
+    return results
+
+
+def _call_model (args):
+    func, task = args
+    return func(_model, task)
+
+
+def map_model (func, obj, tasks, nworkers=None):
+    """
+    Evaluate func(obj, task) for every task over worker processes which each hold a copy of obj.
+    The workers are forked after obj is built and solved so they inherit it, nothing is rebuilt.
+    Where fork is not available (or nworkers is 1) everything runs in this process.
+
+    args:
+        func: func(obj, task), must be picklable (defined at module level)
+        obj: radia object, or anything func takes such as a dict of radia objects
+        tasks: list of tasks
+        nworkers: number of worker processes (default os.cpu_count())
+    returns:
+        list of results in the order of tasks
+    """
+    global _model
+    tasks = list(tasks)
+
+    if nworkers is None:
+        nworkers = os.cpu_count()
+    nworkers = max(1, min(nworkers, len(tasks)))
+    if nworkers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [func(obj, task) for task in tasks]
+
+    _model = obj
+    try:
+        with multiprocessing.get_context('fork').Pool(nworkers) as pool:
+            return pool.map(_call_model, [(func, task) for task in tasks], chunksize=1)
+    finally:
+        _model = None
@@ -1,13 +1,81 @@
+import os
 import radia as rad
 import numpy as np
-from pkg_resources import resource_stream
 
-import panel as pn
-import vtk
-import numpy as np
-from scipy.optimize import curve_fit
+# panel and vtk are only imported when needed to keep importing radiamodels fast
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+_panel_vtk_enabled = False
+
+
+def _import_panel_vtk ():
+    """Import panel and vtk, enabling VTK support in Panel the first time"""
+    global _panel_vtk_enabled
+    import panel as pn
+    import vtk
+
+    if not _panel_vtk_enabled:
+        pn.extension('vtk')  # Enable VTK support in Panel
+        _panel_vtk_enabled = True
+    return pn, vtk
+
+
+def _vtk_cells (vtk, vertices, lengths, colors, ranges, override_color=None):
+    """
+    Convert the flat vertex, length and color lists from rad.ObjDrwVTK to vtk points, a cell
+    array and a cell color array in bulk.  Cells with any vertex outside of ranges are dropped.
+
+    args:
+        vtk: the vtk module
+        vertices: flat list of x, y, z of all vertices
+        lengths: number of vertices in each cell
+        colors: flat list of r, g, b in [0, 1] for each cell
+        ranges: [[xmin, xmax], [ymin, ymax], [zmin, zmax]], None for no limit
+        override_color: [r, g, b] used for all cells if given
+    returns:
+        vtkPoints, vtkCellArray, vtkUnsignedCharArray
+    """
+    from vtk.util import numpy_support
+
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    # Mask vertices outside of the ranges, then drop every cell owning one of them
+    cell_of_vertex = np.repeat(np.arange(len(lengths)), lengths)
+    outside = np.zeros(len(vertices), dtype=bool)
+    for axis, (vmin, vmax) in enumerate(ranges):
+        if vmin is not None:
+            outside |= vertices[:, axis] < vmin
+        if vmax is not None:
+            outside |= vertices[:, axis] > vmax
+    keep_cell = np.ones(len(lengths), dtype=bool)
+    keep_cell[cell_of_vertex[outside]] = False
+
+    # Every cell has its own points, so the connectivity is just 0, 1, 2, ...
+    id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+    kept_vertices = np.ascontiguousarray(vertices[keep_cell[cell_of_vertex]])
+    offsets = np.concatenate([[0], np.cumsum(lengths[keep_cell])]).astype(id_type)
+    connectivity = np.arange(len(kept_vertices)).astype(id_type)
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(kept_vertices, deep=True))
 
-pn.extension('vtk')  # Enable VTK support in Panel
+    cells = vtk.vtkCellArray()
+    cells.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True),
+    )
+
+    # Per-cell colors (convert to 0-255)
+    if override_color:
+        rgb = np.tile(np.asarray(override_color, dtype=float), (int(keep_cell.sum()), 1))
+    else:
+        rgb = np.asarray(colors, dtype=float).reshape(-1, 3)[keep_cell]
+    rgb = np.ascontiguousarray((rgb * 255).astype(np.uint8))
+    colors_array = numpy_support.numpy_to_vtk(rgb, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+
+    return points, cells, colors_array
 
 
 def draw_radia_vtk(
@@ -49,6 +117,8 @@ def draw_radia_vtk(
     - A Panel VTK object for visualization.
     """
 
+    pn, vtk = _import_panel_vtk()
+
     # 🔹 Validate zrange
     if zrange[0] is not None and zrange[1] is not None:
         if zrange[0] >= zrange[1]:
@@ -94,47 +164,11 @@ def draw_radia_vtk(
     line_lengths = line_data.get("lengths", [])
     line_colors = line_data.get("colors", [])
 
-    # 🔹 Convert polygon vertices into VTK format (Filtering based on zrange)
-    points = vtk.vtkPoints()
-    polys = vtk.vtkCellArray()
-    poly_colors_array = vtk.vtkUnsignedCharArray()
-    poly_colors_array.SetNumberOfComponents(3)  # RGB format
-    poly_colors_array.SetName("PolyColors")
+    ranges = [xrange, yrange, zrange]
 
-    index = 0
-    num_faces = len(poly_lengths)
-
-    for i in range(num_faces):
-        length = poly_lengths[i]
-        face_vertices = [poly_vertices[j:j+3] for j in range(index, index + length * 3, 3)]
-        index += length * 3
-
-        # 🔹 Exclude face if any vertex is outside zrange
-        if any(
-            (xrange[0] is not None and vertex[0] < xrange[0]) or
-            (xrange[1] is not None and vertex[0] > xrange[1]) or
-            (yrange[0] is not None and vertex[1] < yrange[0]) or
-            (yrange[1] is not None and vertex[1] > yrange[1]) or
-            (zrange[0] is not None and vertex[2] < zrange[0]) or
-            (zrange[1] is not None and vertex[2] > zrange[1]) 
-            for vertex in face_vertices
-        ):
-            continue
-
-        polygon = vtk.vtkPolygon()
-        polygon.GetPointIds().SetNumberOfIds(length)
-
-        for j, vertex in enumerate(face_vertices):
-            points.InsertNextPoint(vertex)
-            polygon.GetPointIds().SetId(j, points.GetNumberOfPoints() - 1)
-
-        polys.InsertNextCell(polygon)
-
-        # Assign per-face colors (convert to 0-255)
-        r = int(poly_colors[i * 3] * 255)
-        g = int(poly_colors[i * 3 + 1] * 255)
-        b = int(poly_colors[i * 3 + 2] * 255)
-        poly_colors_array.InsertNextTuple3(r, g, b)
+    # 🔹 Convert polygon vertices into VTK format (Filtering based on x/y/zrange)
+    points, polys, poly_colors_array = _vtk_cells(vtk, poly_vertices, poly_lengths, poly_colors, ranges)
+    poly_colors_array.SetName("PolyColors")
 
     # Create a PolyData object and apply colors
     polydata = vtk.vtkPolyData()
@@ -150,46 +184,10 @@ def draw_radia_vtk(
     poly_actor.SetMapper(poly_mapper)
     poly_actor.GetProperty().SetOpacity(face_opacity)
 
-    # 🔹 Convert line vertices into VTK format (Filtering based on zrange)
-    line_points = vtk.vtkPoints()
-    lines = vtk.vtkCellArray()
-    line_colors_array = vtk.vtkUnsignedCharArray()
-    line_colors_array.SetNumberOfComponents(3)
+    # 🔹 Convert line vertices into VTK format (Filtering based on x/y/zrange)
+    line_points, lines, line_colors_array = _vtk_cells(vtk, line_vertices, line_lengths, line_colors, ranges, linecolor)
     line_colors_array.SetName("LineColors")
 
-    index = 0
-    num_lines = len(line_lengths)
-
-    for i in range(num_lines):
-        length = line_lengths[i]
-        line_vertices_group = [line_vertices[j:j+3] for j in range(index, index + length * 3, 3)]
-        index += length * 3
-
-        # 🔹 Exclude line if any vertex is outside zrange
-        if any(
-            (xrange[0] is not None and vertex[0] < xrange[0]) or
-            (xrange[1] is not None and vertex[0] > xrange[1]) or
-            (yrange[0] is not None and vertex[1] < yrange[0]) or
-            (yrange[1] is not None and vertex[1] > yrange[1]) or
-            (zrange[0] is not None and vertex[2] < zrange[0]) or
-            (zrange[1] is not None and vertex[2] > zrange[1])
-            for vertex in line_vertices_group
-        ):
-            continue
-
-        line = vtk.vtkPolyLine()
-        line.GetPointIds().SetNumberOfIds(length)
-
-        for j, vertex in enumerate(line_vertices_group):
-            line_points.InsertNextPoint(vertex)
-            line.GetPointIds().SetId(j, line_points.GetNumberOfPoints() - 1)
-
-        lines.InsertNextCell(line)
-
-        # Apply override color if defined, otherwise use original line colors
-        r, g, b = [int(c * 255) for c in (linecolor if linecolor else line_colors[i * 3: i * 3 + 3])]
-        line_colors_array.InsertNextTuple3(r, g, b)
-
     # Create a PolyData object for lines
     line_polydata = vtk.vtkPolyData()
     line_polydata.SetPoints(line_points)
@@ -233,23 +231,53 @@ def get_beff_bn (Z, B, period, nh=7, debug=False):
     returns:
         [beff, [b1, b3, b5, ...]]
     """
-    def harm(z, *p):
-        z = np.asarray(z)
-        result = np.zeros_like(z, dtype=float)
-        for i in range(len(p)):
-            h = 2 * i + 1
-            result += -p[i] * np.sin(h * 2 * np.pi * z / period)
-        return result
-
-    popt, pcov = curve_fit(harm, Z, [b[1] for b in B], p0=[1]*nh)
+    By = np.asarray(B, dtype=float)[:, 1]
+    beff, bn = get_beff_bn_batch(Z, By, period, nh=nh)
 
     if debug:
-        for i, p in enumerate(popt):
+        for i, p in enumerate(bn):
             h = 2 * i + 1
             print(f'{h:2d} {p:9.5f}')
-    beff = float(np.sqrt(sum([(popt[i]/(2*i+1))**2 for i in range(len(popt))])))
-    
-    return [beff, popt.tolist()]
+
+    return [beff, bn.tolist()]
+
+def get_beff_bn_batch (Z, By, period, nh=7, free_phase=False):
+    """
+    Get the effective field and odd harmonics of many field traces at once.  The fit to
+    -bn*sin(n*2*pi*z/period) is linear in bn so all traces are solved with one least-squares call
+    sharing the same design matrix.
+
+    args:
+        Z: z-positions (N,) common to all traces
+        By: field traces with shape (..., N), eg (ngaps, N) or (ny, nx, N)
+        period: period in mm
+        nh: number of odd harmonics to consider
+        free_phase: if True also fit cos terms and return the amplitude of each harmonic,
+                    for traces that are not sin-like about z=0
+    returns:
+        beff with shape (...) and bn with shape (..., nh)
+    """
+    Z = np.asarray(Z, dtype=float)
+    By = np.asarray(By, dtype=float)
+    shape = By.shape[:-1]
+
+    h = 2 * np.arange(nh) + 1
+    phase = 2 * np.pi * np.outer(Z, h) / period
+    A = -np.sin(phase)
+    if free_phase:
+        A = np.hstack([A, np.cos(phase)])
+
+    coef = np.linalg.lstsq(A, By.reshape(-1, len(Z)).T, rcond=None)[0].T
+    if free_phase:
+        bn = np.hypot(coef[:, :nh], coef[:, nh:])
+    else:
+        bn = coef
+
+    beff = np.sqrt(np.sum((bn / h)**2, axis=1))
+
+    if shape == ():
+        return float(beff[0]), bn[0]
+    return beff.reshape(shape), bn.reshape(shape + (nh,))
 
 def get_beff (Z, By, nperiods=None, harmonics=False, debug=False):
     """
@@ -295,28 +323,106 @@ def b2k_mm (b, period):
     """Convert magnetic field to K where period is in mm"""
     return 0.09336*b*period
 
+# Material registry for this process: parsed BH tables by file and radia materials by key.
+# Each material is stored with its radia dump so that a stale ID (eg after rad.UtiDelAll) is
+# noticed and the material is created again.
+_bh_tables = {}
+_materials = {}
+
+
+def _material_dump (matid):
+    try:
+        return rad.UtiDmp(matid, 'asc')
+    except Exception:
+        # radia raises if the element no longer exists
+        return None
+
+
+def get_material (key, create):
+    """
+    Get a radia material from the registry, creating it with create() only if key was not
+    asked for before in this process or its radia element no longer exists.
+
+    args:
+        key: hashable description of the material, eg ('MatStd', 'NdFeB', 1.3)
+        create: function returning a new radia material
+    returns:
+        radia material ID
+    """
+    entry = _materials.get(key)
+    if entry is not None and _material_dump(entry[0]) == entry[1]:
+        return entry[0]
+
+    matid = create()
+    _materials[key] = (matid, _material_dump(matid))
+    return matid
+
+
+def get_material_key (matid):
+    """Get the registry key of a radia material ID, None if it did not come from the registry"""
+    for key, (registered_id, dump) in _materials.items():
+        if registered_id == matid and _material_dump(matid) == dump:
+            return key
+    return None
+
+
+def clear_materials ():
+    """Forget all registered materials, eg after rad.UtiDelAll()"""
+    _materials.clear()
+    return
+
+
+def get_material_linear (ksi, mr):
+    """Registered rad.MatLin(ksi, mr)"""
+    mr = mr if np.ndim(mr) == 0 else tuple(float(m) for m in mr)
+    key = ('MatLin', tuple(float(k) for k in ksi), mr)
+    return get_material(key, lambda: rad.MatLin(list(ksi), mr if np.ndim(mr) == 0 else list(mr)))
+
+
+def get_material_std (name, br=None):
+    """Registered rad.MatStd(name, br)"""
+    if br is None:
+        return get_material(('MatStd', name), lambda: rad.MatStd(name))
+    return get_material(('MatStd', name, float(br)), lambda: rad.MatStd(name, br))
+
+
+def read_bh_table (filename):
+    """
+    Read a bh curve file of H(Oe) vs B(G) and convert to myu0*H(T) vs myu0*M(T).
+    Each file is only read once per process.
+
+    returns:
+        (N, 2) array of [myu0*H, myu0*M]
+    """
+    filename = os.path.abspath(filename)
+    if filename not in _bh_tables:
+        HB = np.loadtxt(filename, ndmin=2)
+
+        # H(Oe) vs B(G) to myu0*H(A/m) vs myu0*M(T)=B(T)-myu0*H(A/m)
+        myu0 = 4e-7 * np.pi
+
+        # conversion factor between oersted and A/m
+        conversion = 1000 / 4 / np.pi
+
+        radHP = conversion * myu0 * HB[:, 0]
+        radMP = 1e-4 * HB[:, 1] - radHP
+        table = np.column_stack([radHP, radMP])
+        table.flags.writeable = False
+        _bh_tables[filename] = table
+
+    return _bh_tables[filename]
+
+
 def get_magnetic_material_permendur ():
-    return get_magnetic_material(filename=resource_stream (__name__,'data/PermendurNEOMAX.txt'))
+    return get_magnetic_material(filename=os.path.join(DATA_DIR, 'PermendurNEOMAX.txt'))
 
 def get_magnetic_material (filename):
     '''
-    Get magnetic material defined by bh curve in file
+    Get magnetic material defined by bh curve in file.  The material is created once per
+    process and the same radia ID is returned on later calls.
     '''
-    # Setup permendur material for radia
-    Permendur = np.loadtxt(filename)
-    HP = [x[0] for x in Permendur]
-    BP = [x[1] for x in Permendur]
-
-    # H(Oe) vs B(G) to myu0*H(A/m) vs myu0*M(T)=B(T)-myu0*H(A/m)
-    myu0 = 4e-7 * np.pi
-
-    # conversion factor between oersted and A/m
-    conversion = 1000 / 4 / np.pi
-
-    radHP = [conversion * myu0 * x for x in HP]
-    radMP = [1e-4 * x[1] - x[0] for x in zip(radHP, BP)]
-    radHMP = [[x[0], x[1]] for x in zip(radHP, radMP)]
-    return rad.MatSatIsoTab(radHMP)
+    key = ('MatSatIsoTab', os.path.abspath(filename))
+    return get_material(key, lambda: rad.MatSatIsoTab(read_bh_table(filename).tolist()))
 
 
 def write_params_to_file (p, fn):